@@ -0,0 +1,152 @@
+"""
+Offline benchmarks of pywebcoos against a local mock WebCOOS server.
+
+Run from the repository root, e.g.:
+    python benchmarks/benchmark.py --latency 0.02 --elements 2000 --label my-branch
+    python benchmarks/benchmark.py --compare benchmarks/results/main.json benchmarks/results/my-branch.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from importlib import metadata
+
+import pytz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pywebcoos  # noqa: E402
+from pywebcoos.testing import MockWebCOOS  # noqa: E402
+
+
+CAMERA = 'Charleston Harbor, SC'
+PRODUCT = 'one-minute-stills'
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def run(args):
+    '''
+    Function to run each benchmark and return the results as a dict.
+    '''
+    results = {'label': args.label,
+               'version': _version(),
+               'python': platform.python_version(),
+               'config': {'latency': args.latency, 'elements': args.elements, 'page_size': args.page_size,
+                          'file_size': args.file_size, 'error_rate': args.error_rate},
+               'timings': {}}
+    timings = results['timings']
+    with MockWebCOOS(n_elements=args.elements, page_size=args.page_size, file_size=args.file_size,
+                     latency=args.latency, error_rate=args.error_rate) as server:
+        retry = pywebcoos.RetryPolicy(backoff=0.01)
+
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            api = pywebcoos.API(server.token, api_base_url=server.api_base_url, retry=retry)
+        timings['startup_s'] = (time.perf_counter() - t0) / args.repeat
+
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            pywebcoos.API(server.token, api_base_url=server.api_base_url, retry=retry, lazy=True)
+        timings['startup_lazy_s'] = (time.perf_counter() - t0) / args.repeat
+
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            date_range = api.get_inventory(CAMERA, PRODUCT)
+        timings['get_inventory_s'] = (time.perf_counter() - t0) / args.repeat
+
+        start = api._parse_iso(date_range[0]).isoformat()
+        stop = api._parse_iso(date_range[1]).isoformat()
+        service_slug, inventory = api._get_service_slug(CAMERA, PRODUCT)
+        t0 = time.perf_counter()
+        elements = api._get_elements(service_slug, start, stop, 1, api.api_base_url, api.HEADERS)
+        elapsed = time.perf_counter() - t0
+        timings['list_elements_s'] = elapsed
+        timings['list_elements_per_s'] = len(elements) / elapsed
+
+        # Download the first n_files files with each number of workers #
+        local_start, local_stop = _local_window(api, elements[:args.files])
+        for workers in args.workers:
+            save_dir = tempfile.mkdtemp(prefix='pywebcoos-bench-')
+            try:
+                t0 = time.perf_counter()
+                filenames = api.download(CAMERA, PRODUCT, local_start, local_stop, 1, save_dir, max_workers=workers)
+                elapsed = time.perf_counter() - t0
+            finally:
+                shutil.rmtree(save_dir)
+            timings[f'download_{workers}_workers_files_per_s'] = len(filenames) / elapsed
+            timings[f'download_{workers}_workers_MB_per_s'] = len(filenames) * args.file_size / 1e6 / elapsed
+        results['requests'] = server.requests
+    return results
+
+
+def compare(paths):
+    '''
+    Function to print the timings of several results files side by side.
+    '''
+    runs = []
+    for path in paths:
+        with open(path) as f:
+            runs.append(json.load(f))
+    keys = sorted(set(k for r in runs for k in r['timings']))
+    print('metric'.ljust(40) + ''.join(str(r['label']).rjust(16) for r in runs))
+    for key in keys:
+        print(key.ljust(40) + ''.join(_format(r['timings'].get(key)).rjust(16) for r in runs))
+
+
+def _local_window(api, elements):
+    # download takes local yyyymmddHHMM times, so convert the UTC element times to the camera's timezone #
+    tz = pytz.timezone(api._get_timezone(CAMERA))
+    first = elements[0].timestamp.astimezone(tz)
+    last = elements[-1].timestamp.astimezone(tz)
+    return first.strftime('%Y%m%d%H%M'), last.strftime('%Y%m%d%H%M')
+
+
+def _version():
+    try:
+        return metadata.version('pywebcoos')
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def _format(value):
+    return '-' if value is None else f'{value:.4g}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--label', default='current', help='Name of this run, used for the results filename.')
+    parser.add_argument('--latency', type=float, default=0.01, help='Seconds added to each mock response.')
+    parser.add_argument('--elements', type=int, default=1440, help='Elements per product.')
+    parser.add_argument('--page-size', type=int, default=100, help='Elements per /elements/ page.')
+    parser.add_argument('--file-size', type=int, default=200000, help='Bytes per file.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with a 503.')
+    parser.add_argument('--files', type=int, default=100, help='Number of files to download.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8], help='max_workers values to download with.')
+    parser.add_argument('--repeat', type=int, default=5, help='Repeats of the startup and inventory timings.')
+    parser.add_argument('--output', help='Results file. Default is benchmarks/results/<label>.json.')
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS', help='Compare results files instead of running.')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.compare)
+        return
+
+    logging.disable(logging.WARNING)
+    results = run(args)
+    output = args.output or os.path.join(RESULTS_DIR, f'{args.label}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    for key, value in results['timings'].items():
+        print(f'{key.ljust(40)}{_format(value).rjust(16)}')
+    print(f'Results saved to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,20 +5,181 @@ Created on Mon Sep  9 15:32:29 2024
 @author: Matthew.Conlin
 """
 
+import contextlib
+import contextvars
 import datetime
+import functools
 import logging 
-import numpy as np
 import os
-import pandas as pd
+import queue
 import requests
-import pytz
+import threading
+import time
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 
-from . import timezones
+from .base import BaseAPI
+from .cache import MetadataCache
+from .manifest import MANIFEST_NAME, Manifest
+from .retry import AdaptiveLimiter, RetryPolicy
+from .sinks import Sink
+from .stats import RequestInfo, RunStats
 
 
-class API():
+# Base URL of the WebCOOS API #
+API_BASE_URL = 'https://app.webcoos.org/webcoos/api/v1'
+# Size of the chunks files are downloaded in, in bytes #
+CHUNK_SIZE = 1024 * 1024
+# (connect, read) timeouts of each request, in seconds #
+REQUEST_TIMEOUT = (10, 120)
+# Elements per page of the /elements/ query, used to estimate how many requests a query takes #
+PAGE_SIZE_ELEMENTS = 100
+# Most bytes of fetched files held in memory while they are written to a sink that packs them into shards #
+SINK_BUFFER_BYTES = 256 * 1024 * 1024
+# Most pages of a window listed ahead of the consumer when windows are queried in parallel #
+WINDOW_PAGE_BUFFER = 4
 
-    def __init__(self, token, verbose=False):
+
+class _Call():
+    '''
+    State of a running API call: its RunStats and any per-host connection limits (see download_many). It is
+    kept in the _call context variable, so calls made at once from several threads on one API each keep their
+    own, and is carried into the call's worker threads by _submit.
+    '''
+
+    def __init__(self, api, stats, host_limits=None):
+        self.api = api
+        self.stats = stats
+        self.host_limits = host_limits
+
+
+_call = contextvars.ContextVar('pywebcoos_call', default=None)
+
+
+def _submit(executor, function, *args):
+    '''
+    Function to submit function(*args) to executor, run in a copy of the current context so that the
+    requests it makes count towards the running call.
+    '''
+    return executor.submit(contextvars.copy_context().run, function, *args)
+
+
+def _iter_in_context(context, iterable):
+    '''
+    Generator of the items of iterable, each one produced within context (e.g. for a generator that keeps
+    making requests for a call after the call has returned it).
+    '''
+    iterator = iter(iterable)
+    try:
+        while True:
+            try:
+                item = context.run(next, iterator)
+            except StopIteration:
+                return
+            yield item
+    finally:
+        if hasattr(iterator, 'close'):
+            context.run(iterator.close)
+
+
+def _instrumented(method):
+    '''
+    Decorator to collect the RunStats of an API call into self.last_stats and pass them to the on_stats hooks.
+    API calls made while another one is running (in the same thread or its workers) count towards the outer call.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._stats is not None:
+            return method(self, *args, **kwargs)
+        stats = RunStats(method.__name__)
+        token = _call.set(_Call(self, stats))
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            _call.reset(token)
+            self._finish_stats(stats)
+    return wrapper
+
+
+class _HostLimits():
+    '''
+    Per-host limit on the number of simultaneous requests.
+    '''
+
+    def __init__(self, max_per_host):
+        self.max_per_host = max_per_host
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def slot(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._semaphores[host]
+
+
+class _ByteBudget():
+    '''
+    Bytes held by the files being fetched ahead of the consumer, by their position in the queue. Files are
+    charged their size when it is known and otherwise as their bytes arrive. A fetch that would go over the
+    limit waits until the files before it are consumed, except for the file at the head of the queue, so
+    a single file larger than the limit is still fetched.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.head = 0
+        self._held = {}
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def reserve(self, position, n_bytes):
+        '''
+        Function to charge a file n_bytes before it is fetched, if they fit. Returns whether they did.
+        '''
+        with self._condition:
+            if position != self.head and self.used + n_bytes > self.max_bytes:
+                return False
+            self._held[position] = n_bytes
+            self.used += n_bytes
+            return True
+
+    def charge(self, position, n_bytes):
+        '''
+        Function to charge a file for its first n_bytes, waiting for room if they go over the limit.
+        '''
+        with self._condition:
+            extra = n_bytes - self._held.get(position, 0)
+            if extra <= 0:
+                return
+            while position != self.head and self.used + extra > self.max_bytes and not self._closed:
+                self._condition.wait()
+            self._held[position] = n_bytes
+            self.used += extra
+
+    def release(self, position):
+        '''
+        Function to free the bytes of the file at the head of the queue once it has been consumed.
+        '''
+        with self._condition:
+            self.used -= self._held.pop(position, 0)
+            self.head = position + 1
+            self._condition.notify_all()
+
+    def close(self):
+        # Let any waiting fetch finish once the consumer has stopped #
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class API(BaseAPI):
+
+    def __init__(self, token, verbose=False, cache_dir=None, cache_ttl=None, retry=None, max_concurrency=64,
+                 api_base_url=API_BASE_URL, hooks=None, lazy=False):
         '''
         Class to interface with the WebCOOS API.
         
@@ -30,6 +191,26 @@ class API():
             Whether or not to make the API calls verbose in their output. If True, relevant logging
             messages will be shown. If False, only error logging messages will be shown.
             Default is False.
+        cache_dir : str, optional
+            Directory in which to cache the assets json and product inventories between API objects
+            and processes. Default is None (no caching).
+        cache_ttl : dict, optional
+            Time-to-live in seconds of each cached resource, e.g. {'assets': 3600, 'inventory': 600}.
+            Only used if cache_dir is given. Default is None (use the defaults in cache.DEFAULT_TTL).
+        retry : RetryPolicy, optional
+            How requests that fail with a connection error or a retryable status (e.g. 429, 503) are retried.
+            Default is None (RetryPolicy() defaults: 5 retries with exponential backoff and jitter).
+        max_concurrency : int, optional
+            Most requests this object makes at once. The limit is lowered automatically while the server is
+            pushing back and raised again as requests succeed. Default is 64.
+        api_base_url : str, optional
+            Base URL of the API, e.g. to point at a local mock server. Default is the WebCOOS API.
+        hooks : list, optional
+            Instrumentation hooks, see add_hook. The statistics of the latest call are also kept in
+            self.last_stats. Default is None.
+        lazy : bool, optional
+            If True, no request is made until the object is first used, so the token is only checked (and a
+            ValueError raised if it is invalid) at that point. Default is False.
         
         Example usage:
         _ _ _ _ _ _ 
@@ -37,43 +218,71 @@ class API():
         print(api.get_cameras()) 
         fnames = webcoos.download('Charleston Harbor, SC',201901011200 201901011300)
         '''
-        # Set the logging level #
-        if verbose:
-            logging.basicConfig(level=logging.INFO)
+        self._setup(token, verbose, api_base_url)
+        # Keep-alive session shared by all requests so connections are reused. The pool is sized once to hold
+        # a connection for every request the limiter lets through, so it never has to be replaced mid-session #
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Retries and adaptive concurrency limit shared by every request #
+        self.retry = retry if retry is not None else RetryPolicy()
+        self._limiter = AdaptiveLimiter(max_concurrency)
+        # Instrumentation hooks and the stats of the latest API call #
+        self.hooks = list(hooks) if hooks is not None else []
+        self.last_stats = None
+        # Optional on-disk cache of the assets json and inventories #
+        if cache_dir is not None:
+            self.cache = MetadataCache(cache_dir, cache_ttl)
         else:
-            logging.basicConfig(level=logging.WARNING)
-
-        # Establish the base URL and headers for requests #
-        self.api_base_url = 'https://app.webcoos.org/webcoos/api/v1'
-        self.HEADERS = {
-            'Authorization': 'Token '+token,
-            'Accept': 'application/json'
-        }      
+            self.cache = None
+        self.assets_json = None
+        self._cameras = None
+        self._assets_lock = threading.Lock()
+        if not lazy:
+            self._load_assets()
+
+    @_instrumented
+    def refresh(self):
+        '''
+        Function to discard cached metadata and re-download the assets json.
+        '''
+        if self.cache is not None:
+            self.cache.clear()
+        self._load_assets()
+
+    @_instrumented
+    def _load_assets(self):
+        '''
+        Function to get the assets json (from the cache if it is fresh) and the camera list.
+        '''
         #Access the json assets via the webcoos API and get the camera list
-        self.assets_json = self._make_api_request(self.api_base_url, self.HEADERS)
-        if self.assets_json is not None:
-            df_cams = self._get_camera_list(self.assets_json)
-            self.cameras = df_cams
+        assets_json = self._cached('assets', '', lambda: self._make_api_request(self.api_base_url, self.HEADERS))
+        if assets_json is not None:
+            self._set_assets(assets_json)
         else:
             raise ValueError('API access token is not valid.')
-               
-    def get_cameras(self):
-        return self.cameras
-    
-    def get_products(self, camera_name):
+
+    def _ensure_assets(self):
         '''
-        Function to view the available products at a camera.
+        Function to load the assets json on first use if the object was created with lazy=True.
         '''
-        self._check_camera_name(camera_name)
-        
-        feeds = self._get_camera_feeds(camera_name, self.assets_json)
-        feed_name = 'raw-video-data'
-        products = self._get_camera_products(feed_name, feeds, camera_name)
-        product_labels = []
-        for product in products:
-            product_labels.append(product['data']['common']['label'])  # Returning the product label      
-        return product_labels
-    
+        if self.assets_json is None:
+            with self._assets_lock:
+                if self.assets_json is None:
+                    self._load_assets()
+
+    def _cached(self, resource, key, fetch):
+        '''
+        Function to get a resource through the cache, if one is configured.
+        '''
+        if self.cache is None:
+            return fetch()
+        # Cache entries are per base URL and token since assets can differ between accounts #
+        key = '|'.join([self.api_base_url, self.HEADERS['Authorization'], key])
+        return self.cache.get(resource, key, fetch)
+               
+    @_instrumented
     def get_inventory(self, camera_name, product_name):
         '''
         Function to view available data for a product at a camera.
@@ -81,156 +290,751 @@ class API():
         self._check_camera_name(camera_name)
         self._check_product_name(camera_name, product_name)
         
-        feeds = self._get_camera_feeds(camera_name, self.assets_json)
-        feed_name = 'raw-video-data'
-        products = self._get_camera_products(feed_name, feeds, camera_name)
-        service_slug, df_inv = self._get_service_slug(product_name, products, feed_name, camera_name, self.api_base_url, self.HEADERS)
-        # What is the range of dates with data?
-        min_date = df_inv['Bin Start'].min()
-        max_date = df_inv['Bin End'].max()
-        return [min_date, max_date]
+        service_slug, inventory = self._get_service_slug(camera_name, product_name)
+        return self._get_inventory_range(inventory)
         
-    def download(self, camera_name, product_name, start, stop, interval, save_dir):
+    @_instrumented
+    def download(self, camera_name, product_name, start, stop, interval, save_dir, max_workers=1, query_workers=1,
+                 chunk_size=CHUNK_SIZE):
         '''
-        Function to download imagery.
+        Function to download imagery. start and stop are local times (yyyymmddHHMM). To download several windows
+        at once, give start as a list of (start, stop) tuples or a schedule such as schedule.Daily('1000', '1010',
+        20240101, 20241231), and stop as None; the windows are listed in as few queries as possible.
+        interval is a number of minutes (files whose minute is a multiple of it are downloaded) or a
+        sampling.Sampler, e.g. sampling.Every('15s') or sampling.Nearest('10min').
+        Set max_workers > 1 to download files concurrently. Set query_workers > 1
+        to split the element listing into sub-windows, balanced by the product inventory, that are queried in parallel.
+        Files are written to a .part file in chunk_size byte chunks and renamed once complete, so an interrupted
+        download is resumed the next time it is requested.
+        save_dir can also be a sinks.Sink, e.g. sinks.PartitionedSink(root) for a root/camera/product/YYYY/MM/DD
+        layout or sinks.TarSink(root) to pack the files into tar shards; the locations of the files in the sink
+        are returned, and files already in it are not downloaded again.
+        '''
+        filtered_elements = self._list_elements(camera_name, product_name, start, stop, interval, query_workers)
+        filenames = self._download_imagery(filtered_elements, save_dir, max_workers, chunk_size,
+                                           camera_name=camera_name, product_name=product_name)
+        return filenames
+
+    @_instrumented
+    def plan_download(self, camera_name, product_name, start, stop, interval, n_shards=1, units_per_shard=4):
         '''
+        Function to split a download into work units of about equal estimated size (from the inventory's
+        Count and Bytes columns) and assign them to n_shards shards, without listing or downloading anything.
+        The plan is deterministic, so every machine given the same plan runs its own part of the job, with no
+        overlaps or gaps: save the plan, then run API.download_shard(plan, i, save_dir) for each shard i.
+        
+        returns:
+        _ _ _ _ _ _ 
+        A sharding.DownloadPlan, whose total_files and total_bytes estimate the size of the job.
+        
+        Example usage:
+        _ _ _ _ _ _ 
+        plan = api.plan_download('Charleston Harbor, SC', 'one-minute-stills', 202401010000, 202501010000, 1, n_shards=8)
+        print(plan.total_bytes, plan.shard_bytes())
+        plan.save('plan.json')
+        '''
+        from . import sharding
+        from .sampling import as_sampler
+        if n_shards < 1 or units_per_shard < 1:
+            raise ValueError('n_shards and units_per_shard must be at least 1.')
         start = str(start)
         stop = str(stop)
+        self._check_download_args(camera_name, product_name, start, stop)
+        sampler = as_sampler(interval)
+        start = self._local2ISO(start, camera_name)
+        stop = self._local2ISO(stop, camera_name)
+        service_slug, inventory = self._get_service_slug(camera_name, product_name)
+        self._check_date_bounds(start, stop, self._get_inventory_range(inventory))
+        units = sharding.plan_units(inventory, self._parse_iso(start), self._parse_iso(stop), n_shards * units_per_shard, sampler)
+        plan = sharding.DownloadPlan(camera_name, product_name, sampler.spec(), sharding.assign_shards(units, n_shards), n_shards)
+        logging.info(plan)
+        return plan
+
+    @_instrumented
+    def download_shard(self, plan, shard, save_dir, max_workers=1, query_workers=1, chunk_size=CHUNK_SIZE):
+        '''
+        Function to download the files of one shard of a plan made by plan_download, given as the plan or
+        the path of a plan saved with DownloadPlan.save. Returns the filenames in element order.
+        '''
+        from .sampling import from_spec
+        if isinstance(plan, (str, os.PathLike)):
+            from .sharding import DownloadPlan
+            plan = DownloadPlan.load(plan)
+        units = plan.shard(shard)
+        self._check_camera_name(plan.camera_name)
+        self._check_product_name(plan.camera_name, plan.product_name)
+        service_slug = self._find_service_slug(plan.camera_name, plan.product_name)
+        last_stop = plan.units[-1].stop
+        # Units include their start but not their stop, except for the job's last unit #
+        windows = [(unit.start, unit.stop if unit.stop == last_stop else
+                    (self._parse_iso(unit.stop) - datetime.timedelta(microseconds=1)).isoformat()) for unit in units]
+        logging.info(f"Downloading shard {shard} of {plan.n_shards}: {len(units)} work units")
+        pages = self._iter_window_pages(service_slug, windows, query_workers, self.api_base_url, self.HEADERS)
+        filtered_elements = self._iter_elements(self._sample_pages(pages, from_spec(plan.interval)))
+        return self._download_imagery(filtered_elements, save_dir, max_workers, chunk_size,
+                                      camera_name=plan.camera_name, product_name=plan.product_name)
+
+    @_instrumented
+    def download_many(self, jobs, max_workers=8, max_connections_per_host=4, query_workers=1, chunk_size=CHUNK_SIZE):
+        '''
+        Function to run several downloads at once. Files from all jobs are downloaded by one shared pool of
+        max_workers threads, and no more than max_connections_per_host requests are made to any one host at a time.
+        A failing job does not stop the others.
+        
+        args:
+        _ _ _ _ _ _ 
+        jobs : list
+            Downloads to run, each a (camera_name, product_name, start, stop, interval, save_dir) tuple or
+            a dict with those keys.
+        max_workers : int, optional
+            Number of files downloaded at once across all jobs. Default is 8.
+        max_connections_per_host : int, optional
+            Maximum number of simultaneous requests to one host, or None for no limit. Default is 4.
+        
+        returns:
+        _ _ _ _ _ _ 
+        A list with a dict for each job, in job order, holding the 'job', the downloaded 'filenames' and
+        the 'error' raised by the job (None if it succeeded). The filenames of a failed job are the files it
+        had in place when it failed.
+        '''
+        keys = ['camera_name', 'product_name', 'start', 'stop', 'interval', 'save_dir']
+        jobs = [dict(job) if isinstance(job, dict) else dict(zip(keys, job)) for job in jobs]
+        results = [{'job': job, 'filenames': [], 'error': None} for job in jobs]
+        if not jobs:
+            return results
+
+        def run_job(i, file_executor):
+            job = jobs[i]
+            try:
+                filtered_elements = self._list_elements(job['camera_name'], job['product_name'], job['start'],
+                                                        job['stop'], job['interval'], query_workers)
+                results[i]['filenames'] = self._download_imagery(filtered_elements, job['save_dir'], max_workers,
+                                                                 chunk_size, executor=file_executor,
+                                                                 camera_name=job['camera_name'],
+                                                                 product_name=job['product_name'],
+                                                                 completed=results[i]['filenames'])
+            except Exception as e:
+                logging.error(f"Download job {i} ({job['camera_name']}, {job['product_name']}) failed: {e}")
+                results[i]['error'] = e
+
+        # The limits only apply to the requests of this call (and its workers) #
+        host_limits = _HostLimits(max_connections_per_host) if max_connections_per_host else None
+        token = _call.set(_Call(self, self._stats, host_limits))
+        try:
+            # Jobs list their elements in their own threads and hand the files to the shared pool #
+            with ThreadPoolExecutor(max_workers=max_workers) as file_executor:
+                with ThreadPoolExecutor(max_workers=min(len(jobs), max_workers)) as job_executor:
+                    for future in [_submit(job_executor, run_job, i, file_executor) for i in range(len(jobs))]:
+                        future.result()
+        finally:
+            _call.reset(token)
+        logging.info(f"{sum(r['error'] is None for r in results)} of {len(jobs)} download jobs succeeded")
+        return results
+
+    @_instrumented
+    def sync(self, camera_name, product_name, save_dir, interval=1, start=None, max_workers=1, chunk_size=CHUNK_SIZE):
+        '''
+        Function to bring save_dir up to date with the latest imagery of a product. A manifest of downloaded
+        files and of the newest element synced is kept in save_dir, so each run only lists elements newer than
+        the previous run and only downloads files that are missing.
+        
+        args:
+        _ _ _ _ _ _ 
+        interval : int or sampling.Sampler, optional
+            Minutes between files, or a sampler, as for download. A sampler's state is not kept between runs,
+            so each run samples from the watermark afresh: a bin of Every (or a group of Nearest) that is still
+            filling when one run ends can have more files kept from it by the next run. Run sync after the
+            bins are complete (or use an interval in minutes) to avoid this. Default is 1.
+        start : str or int, optional
+            Local date (yyyymmddHHMM) to start from on the first sync. Default is None (the start of the
+            product's inventory). Ignored once save_dir has been synced.
         
+        returns:
+        _ _ _ _ _ _ 
+        The filenames downloaded by this run, in element order.
+        '''
         self._check_camera_name(camera_name)
         self._check_product_name(camera_name, product_name)
-        self._check_date_format(start, 'start')
-        self._check_date_format(stop, 'stop')
-        self._check_date_range(camera_name, product_name, start, stop)
+        if start is not None:
+            start = str(start)
+            self._check_date_format(start, 'start')
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
 
-        start = self._local2ISO(start, camera_name)
-        stop = self._local2ISO(stop, camera_name)
-        feeds = self._get_camera_feeds(camera_name, self.assets_json)
-        feed_name = 'raw-video-data'
-        products = self._get_camera_products(feed_name, feeds, camera_name)
-        service_slug, df_inv = self._get_service_slug(product_name, products, feed_name, camera_name, self.api_base_url, self.HEADERS)
-        filtered_elements = self._get_elements(service_slug, start, stop, interval, self.api_base_url, self.HEADERS)
-        filenames = self._download_imagery(filtered_elements, save_dir)
+        service_slug, inventory = self._get_service_slug(camera_name, product_name)
+        with Manifest(os.path.join(save_dir, MANIFEST_NAME)) as manifest:
+            watermark = manifest.get_watermark(service_slug)
+            if watermark is not None:
+                start = watermark
+            elif start is not None:
+                start = self._local2ISO(start, camera_name)
+            else:
+                start = self._get_inventory_range(inventory)[0]
+                if start is None:
+                    # Listing without a lower bound would return the whole history, if anything #
+                    logging.info(f"No data in the inventory of {camera_name} {product_name}, nothing to sync")
+                    return []
+            stop = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0).isoformat()
+            logging.info(f"Syncing {camera_name} {product_name} from {start}")
+
+            def fetch(url, filename, size, timestamp):
+                self._download_file(url, filename, size, chunk_size)
+                manifest.add(service_slug, url, filename, timestamp, os.path.getsize(filename))
+
+            filenames = []
+            newest = self._parse_iso(watermark) if watermark is not None else None
+            futures = []
+            executor = ThreadPoolExecutor(max_workers=max_workers) if max_workers > 1 else None
+            try:
+                for element in self._get_elements(service_slug, start, stop, interval, self.api_base_url, self.HEADERS, stream=True):
+                    url = element.url
+                    timestamp = element.timestamp
+                    newest = timestamp if newest is None else max(newest, timestamp)
+                    if manifest.has(url):
+                        continue
+                    filename = self._get_filename(url, save_dir)
+                    if os.path.exists(filename):  # Downloaded before the manifest existed #
+                        manifest.add(service_slug, url, filename, timestamp.isoformat(), os.path.getsize(filename))
+                        continue
+                    filenames.append(filename)
+                    args = (url, filename, element.size, timestamp.isoformat())
+                    if executor is not None:
+                        futures.append(_submit(executor, fetch, *args))
+                    else:
+                        fetch(*args)
+                for future in futures:
+                    future.result()
+            finally:
+                if executor is not None:
+                    executor.shutdown()
+            # Only move the watermark once every file up to it is in place #
+            if newest is not None:
+                manifest.set_watermark(service_slug, newest.isoformat())
+        logging.info(f"Sync complete. Downloaded {len(filenames)} new files to {save_dir}")
         return filenames
-    
-    def _check_camera_name(self, camera_name):
-        if camera_name not in self.get_cameras()['Camera Name'].values:
-            raise ValueError('Camera is not an available WebCOOS camera.')
-    
-    def _check_product_name(self, camera_name, product_name):
-        if product_name not in self.get_products(camera_name):
-            raise ValueError('Requested product is not available at this camera.')
-            
-    def _check_date_format(self, date, date_name):
-        if len(date) != 12:
-            raise ValueError('Requested '+date_name+' date is of improper format. Format should be yyyymmddHHMM.')
+
+    def watch(self, camera_name, product_name, callback, interval=1, save_dir=None, start=None, poll_interval=60,
+              stop_event=None, max_polls=None, chunk_size=CHUNK_SIZE):
+        '''
+        Function to follow a product as new imagery arrives. The elements query is polled every poll_interval
+        seconds for elements newer than the last one seen, using conditional requests (If-None-Match /
+        If-Modified-Since) so that a poll with nothing new is answered with an empty 304. Each new file is
+        fetched as soon as it is listed and passed to callback(timestamp, element, data), where element is an
+        elements.Element and data is the filename if save_dir is given and the file's bytes otherwise. An
+        element whose file fails to download, or for which callback raises, is logged and skipped, and
+        watching carries on.
+        
+        args:
+        _ _ _ _ _ _ 
+        start : str or int, optional
+            Local date (yyyymmddHHMM) to start from. Default is None (only elements from now on).
+        stop_event : threading.Event, optional
+            Event to set (e.g. from another thread) to stop watching. Default is None.
+        max_polls : int, optional
+            Number of polls to make before returning. Default is None (watch until stop_event is set).
+        
+        returns:
+        _ _ _ _ _ _ 
+        The number of new elements passed to callback without error.
+        
+        Example usage:
+        _ _ _ _ _ _ 
+        api.watch('Charleston Harbor, SC', 'one-minute-stills', lambda t, e, f: print(t, f), save_dir='.', poll_interval=30)
+        '''
+        self._check_camera_name(camera_name)
+        self._check_product_name(camera_name, product_name)
+        if start is not None:
+            start = str(start)
+            self._check_date_format(start, 'start')
+            cursor = self._local2ISO(start, camera_name)
         else:
+            cursor = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0).isoformat()
+        if save_dir is not None and not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        service_slug = self._find_service_slug(camera_name, product_name)
+        logging.info(f"Watching {camera_name} {product_name} from {cursor}")
+
+        # (cursor, urls of the elements at the cursor, validators of the last response, sampling state) carried between polls #
+        from .sampling import as_sampler
+        state = {'cursor': cursor, 'seen': set(), 'validators': None, 'sampling': as_sampler(interval).stream()}
+        n_polls = 0
+        n_new = 0
+        while max_polls is None or n_polls < max_polls:
             try:
-                datetime.datetime(int(date[0:4]), int(date[4:6]), int(date[6:8]), int(date[8:10]), int(date[10:12]))
-            except ValueError:
-                raise ValueError('Requested '+date_name+' date is of improper format. Format should be yyyymmddHHMM.')        
-    
-    def _check_date_range(self, camera_name, product_name, start, stop):
-        starts = self._local2ISO(start, camera_name)
-        stops = self._local2ISO(stop, camera_name)
-        ss = []
-        for s in [starts, stops]:
-            ss.append(datetime.datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16])))
-            
-        dr = self.get_inventory(camera_name, product_name)
-        dtr = []
-        for d in dr:
-            dtr.append(datetime.datetime(int(d[0:4]), int(d[5:7]), int(d[8:10]), int(d[11:13]), int(d[14:16])))
+                n_new += self._poll(service_slug, state, callback, save_dir, chunk_size)
+            except requests.exceptions.RequestException as e:
+                # Keep watching through outages that outlast the retries #
+                logging.error(f"Polling {camera_name} {product_name} failed: {e}")
+            n_polls += 1
+            if max_polls is not None and n_polls >= max_polls:
+                break
+            if stop_event is not None:
+                if stop_event.wait(poll_interval):
+                    break
+            else:
+                time.sleep(poll_interval)
+        return n_new
+
+    @_instrumented
+    def _poll(self, service_slug, state, callback, save_dir, chunk_size):
+        '''
+        Function to list the elements after the watch cursor and hand each new one that is sampled to
+        callback. Returns the number of elements handed over.
+        '''
+        table = self._poll_elements(service_slug, state).sort()
+        cursor = self._parse_iso(state['cursor'])
+        table = table[[element.url not in state['seen'] and element.timestamp >= cursor for element in table]]
+        # Samplers that choose between neighbouring elements may hold the newest ones back until the next poll #
+        selected = state['sampling'].feed(table)
+        n_new = 0
+        for element in selected:
+            # A file that fails to download, or a callback that raises, only loses that element #
+            try:
+                if save_dir is not None:
+                    data = self._get_filename(element.url, save_dir)
+                    if not os.path.exists(data):
+                        self._download_file(element.url, data, element.size, chunk_size)
+                else:
+                    buffer, n_bytes = self._fetch_bytes(element.url, element.size, chunk_size=chunk_size)
+                    del buffer[n_bytes:]
+                    data = buffer
+            except (requests.exceptions.RequestException, IOError) as e:
+                logging.error(f"Failed to fetch {element.url}: {e}")
+                continue
+            try:
+                callback(element.timestamp, element, data)
+            except Exception as e:
+                logging.error(f"Callback failed for {element.url}: {e}")
+                continue
+            n_new += 1
+        # Move the cursor past the new elements #
+        for element in table:
+            if element.timestamp > self._parse_iso(state['cursor']):
+                state['cursor'] = element.timestamp.isoformat()
+                state['seen'] = set()
+            state['seen'].add(element.url)
+        return n_new
+
+    def _poll_elements(self, service_slug, state):
+        '''
+        Function to list every element starting at or after the watch cursor, as an ElementTable. The first
+        page is requested conditionally on the validators of the previous poll with the same cursor, and an
+        empty table is returned if the server says it has not changed.
+        '''
+        from .elements import ElementTable
+        url = f'{self.api_base_url}/elements/'
+        params = {'starting_after': state['cursor'], 'service': service_slug}
+        headers = dict(self.HEADERS)
+        validators = state['validators']
+        if validators is not None and validators[0] == state['cursor']:
+            if validators[1]:
+                headers['If-None-Match'] = validators[1]
+            if validators[2]:
+                headers['If-Modified-Since'] = validators[2]
+        with self._request(url, url_class='elements', headers=headers, params=params) as response:
+            if response.status_code == 304:
+                logging.info("No new elements.")
+                return ElementTable.empty()
+            if response.status_code != 200:
+                logging.error(f"Failed to poll elements: {response.status_code}")
+                response.raise_for_status()
+            data = response.json()
+            state['validators'] = (state['cursor'], response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        self._count(pages=1, elements=len(data['results']))
+        tables = [ElementTable.from_json(data['results'])]
+        # Later pages are only requested when the first one has changed #
+        next_url = data.get('pagination', {}).get('next')
+        page = 1
+        while next_url:
+            page += 1
+            data = self._fetch_page(next_url, None, page, self.HEADERS)
+            tables.append(ElementTable.from_json(data['results']))
+            next_url = data.get('pagination', {}).get('next')
+        return ElementTable.concat(tables)
+
+    def iter_download(self, camera_name, product_name, start, stop, interval, max_workers=4,
+                      max_buffer_bytes=256 * 1024 * 1024, reuse_buffers=False, query_workers=1, chunk_size=CHUNK_SIZE):
+        '''
+        Function to download imagery into memory instead of to files. Returns a generator of
+        (timestamp, element, data) tuples in element order, where timestamp is the element's UTC datetime,
+        element is its elements.Element (timestamp, url, size and id) and data holds the file's bytes. Up to max_workers files are fetched ahead
+        of the one being consumed, as long as the files held in memory fit in max_buffer_bytes (a single
+        file larger than that is still fetched, on its own). Files of unknown size count as their bytes
+        arrive, and fetching ahead pauses at the limit.
         
-        if dtr[0] <= ss[0] <= dtr[1] and dtr[0] <= ss[1] <= dtr[1]:
-            pass
-        else:
-            raise ValueError('At least one requested date bound is outside the range of available data for this product at this camera.')  
-            
+        If reuse_buffers is True, data is a memoryview into a buffer that is reused once the generator moves
+        on to the next file, which saves allocating a new buffer per file. The view is released at that point,
+        so copy it (e.g. bytes(data)) to keep it longer. A buffer still exported then (e.g. by np.frombuffer)
+        is left to its holder and not reused. Otherwise data is a new bytearray for each file.
+        
+        Example usage:
+        _ _ _ _ _ _ 
+        for timestamp, element, data in api.iter_download('Charleston Harbor, SC', 'one-minute-stills', 202401011200, 202401011300, 1):
+            image = decode(data)
+        '''
+        if self._stats is not None:  # Part of a running call #
+            filtered_elements = self._list_elements(camera_name, product_name, start, stop, interval, query_workers)
+            return self._iter_fetched(filtered_elements, max_workers, max_buffer_bytes, reuse_buffers, chunk_size)
+        # The stats run until the generator is exhausted or closed, in a context of their own #
+        stats = RunStats('iter_download')
+        context = contextvars.copy_context()
+        context.run(_call.set, _Call(self, stats))
+        try:
+            filtered_elements = context.run(self._list_elements, camera_name, product_name, start, stop, interval,
+                                            query_workers)
+        except BaseException:
+            self._finish_stats(stats)
+            raise
+        return self._iter_download(filtered_elements, max_workers, max_buffer_bytes, reuse_buffers, chunk_size,
+                                   stats, context)
+
+    def _finish_stats(self, stats):
+        stats.finish()
+        self.last_stats = stats
+        logging.info(stats)
+        self._emit('on_stats', stats)
+
+    def _iter_download(self, filtered_elements, max_workers, max_buffer_bytes, reuse_buffers, chunk_size, stats,
+                       context):
+        '''
+        Generator of (timestamp, element, data) for the elements, fetched ahead by a pool of max_workers
+        threads while the bytes held stay within max_buffer_bytes. The files are fetched within context, so
+        the requests count towards stats, which are finished when the generator is exhausted or closed.
+        '''
+        try:
+            yield from _iter_in_context(context, self._iter_fetched(filtered_elements, max_workers, max_buffer_bytes,
+                                                                    reuse_buffers, chunk_size))
+        finally:
+            self._finish_stats(stats)
+
+    def _iter_fetched(self, filtered_elements, max_workers, max_buffer_bytes, reuse_buffers, chunk_size, executor=None):
+        '''
+        Generator of (timestamp, element, data) for the elements, with up to max_workers fetched ahead with
+        executor, or a pool of max_workers threads of its own if none is given.
+        '''
+        if executor is None:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                yield from self._iter_fetched(filtered_elements, max_workers, max_buffer_bytes, reuse_buffers,
+                                              chunk_size, executor)
+            return
+        buffer_pool = []
+        pending = deque()  # (position, element, future) in element order #
+        budget = _ByteBudget(max_buffer_bytes)
+        position = 0
+        elements = iter(filtered_elements)
+        next_element = next(elements, None)
+        try:
+            while pending or next_element is not None:
+                # Fetch ahead while there are free workers and room in the byte budget #
+                while next_element is not None and len(pending) < max_workers:
+                    if not budget.reserve(position, next_element.size or 0):
+                        break
+                    buffer = buffer_pool.pop() if (reuse_buffers and buffer_pool) else None
+                    future = _submit(executor, self._fetch_bytes, next_element.url, next_element.size, buffer,
+                                     chunk_size, functools.partial(budget.charge, position))
+                    pending.append((position, next_element, future))
+                    position += 1
+                    next_element = next(elements, None)
+
+                head, element, future = pending.popleft()
+                buffer, n_bytes = future.result()
+                timestamp = element.timestamp
+                if reuse_buffers:
+                    view = memoryview(buffer)[:n_bytes]
+                    yield timestamp, element, view
+                    # Release the view so the buffer can be resized when it is reused #
+                    try:
+                        view.release()
+                        buffer_pool.append(buffer)
+                    except BufferError:
+                        logging.debug('Buffer still exported by the caller, not reusing it')
+                else:
+                    del buffer[n_bytes:]
+                    yield timestamp, element, buffer
+                budget.release(head)
+        finally:
+            budget.close()
+
+    def _fetch_bytes(self, url, size=None, buffer=None, chunk_size=CHUNK_SIZE, on_bytes=None):
+        '''
+        Function to download a file into a bytearray, reusing buffer if one is given. Returns the buffer and
+        the number of bytes in it that belong to the file. on_bytes, if given, is called with the number of
+        bytes received so far before each chunk is stored.
+        '''
+        if buffer is None:
+            buffer = bytearray(size or 0)
+        attempt = 0
+        while True:
+            try:
+                with self._request(url, stream=True) as response:
+                    response.raise_for_status()
+                    n_bytes = 0
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        end = n_bytes + len(chunk)
+                        if on_bytes is not None:
+                            on_bytes(end)
+                        if end > len(buffer):
+                            try:
+                                buffer.extend(bytes(end - len(buffer)))
+                            except BufferError:
+                                # The buffer is still exported, so carry on in a new one #
+                                buffer = buffer[:n_bytes] + bytes(end - n_bytes)
+                        buffer[n_bytes:end] = chunk
+                        n_bytes = end
+                break
+            except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError) as e:
+                if attempt >= self.retry.retries:
+                    raise
+                logging.warning(f"Download of {url} was interrupted ({e}), retrying")
+                time.sleep(self.retry.delay(attempt))
+                attempt += 1
+        if size is not None and n_bytes != size:
+            raise IOError(f"Downloaded {n_bytes} bytes of {url} but expected {size}.")
+        self._count(files=1)
+        return buffer, n_bytes
+
+    @_instrumented
+    def list_elements(self, camera_name, product_name, start, stop, interval, query_workers=1):
+        '''
+        Function to list the elements that download would fetch, without downloading them. Returns an
+        elements.ElementTable with the time (UTC), url, size and id of each element in columns; use its
+        to_pandas() method to get a dataframe.
+        '''
+        from .elements import ElementTable
+        tables = self._list_elements(camera_name, product_name, start, stop, interval, query_workers, tables=True)
+        return ElementTable.concat(tables)
+
+    def _list_elements(self, camera_name, product_name, start, stop, interval, query_workers=1, tables=False):
+        '''
+        Function to check the download arguments and return a generator of the filtered elements (or, if
+        tables is True, of an ElementTable of them per page).
+        '''
+        windows = self._get_local_windows(start, stop)
+        if windows is not None:
+            return self._list_window_elements(camera_name, product_name, windows[0], windows[1], interval,
+                                              query_workers, tables)
+        start = str(start)
+        stop = str(stop)
+        
+        self._check_download_args(camera_name, product_name, start, stop)
+        from .sampling import as_sampler
+        interval = as_sampler(interval)
+        start = self._local2ISO(start, camera_name)
+        stop = self._local2ISO(stop, camera_name)
+
+        # The inventory is fetched once and used for both the date range check and the service slug #
+        service_slug, inventory = self._get_service_slug(camera_name, product_name)
+        self._check_date_bounds(start, stop, self._get_inventory_range(inventory))
+        # Elements are streamed so that files start downloading while later pages are still being listed #
+        return self._get_elements(service_slug, start, stop, interval, self.api_base_url, self.HEADERS, stream=True,
+                                  inventory=inventory, query_workers=query_workers, tables=tables)
+    
+    def _list_window_elements(self, camera_name, product_name, local_starts, local_stops, interval, query_workers=1,
+                              tables=False):
+        '''
+        Function to return a generator of the filtered elements in a set of local windows (or, if tables is
+        True, of an ElementTable of them per page). Windows are converted to UTC together, windows that the
+        inventory shows to be empty are skipped, and windows are merged into one query when that takes fewer
+        page requests (see schedule.plan_queries).
+        '''
+        from . import schedule
+        from .sampling import as_sampler
+        self._check_camera_name(camera_name)
+        self._check_product_name(camera_name, product_name)
+        interval = as_sampler(interval)
+        starts = self._local2UTC(local_starts, camera_name)
+        stops = self._local2UTC(local_stops, camera_name)
+        service_slug, inventory = self._get_service_slug(camera_name, product_name)
+        starts, stops = schedule.union_windows(starts, stops)
+        first, last = self._get_inventory_range(inventory)
+        if first is not None:
+            # Windows outside the range of the inventory are dropped, and it's an error if they all are #
+            keep = (stops >= schedule.to_datetime64(first)) & (starts <= schedule.to_datetime64(last))
+            if not keep.any():
+                raise ValueError('At least one requested date bound is outside the range of available data for this product at this camera.')
+            if not keep.all():
+                logging.warning(f"{(~keep).sum()} of {len(keep)} requested windows are outside the range of available data")
+            starts, stops = starts[keep], stops[keep]
+        queries = schedule.plan_queries(inventory, starts, stops, PAGE_SIZE_ELEMENTS)
+        logging.info(f"Listing {len(starts)} windows in {len(queries)} queries")
+        pages = self._iter_window_pages(service_slug, queries, query_workers, self.api_base_url, self.HEADERS)
+        page_tables = self._sample_pages((table.within(starts, stops) for table in pages), interval)
+        if tables:
+            return page_tables
+        return self._iter_elements(page_tables)
+
     def _make_api_request(self, api_base_url, HEADERS):
         '''
         Function to query the webcoos API for available assets
         '''
-        response = requests.get(f"{api_base_url}/assets/", headers=HEADERS)
-
-        # Check the status code of the response
-        if response.status_code == 200:
-            #Return the assets json
-            return response.json()
-        else:
+        with self._request(f"{api_base_url}/assets/", url_class='assets', headers=HEADERS) as response:
+            # Check the status code of the response
+            if response.status_code == 200:
+                #Return the assets json
+                return response.json()
             # raise error information if the request was not successful
             logging.error(f"Failed to retrieve assets: {response.status_code} {response.text}")
+            if response.status_code in self.retry.statuses:
+                response.raise_for_status()  # The server is unavailable, not the token invalid #
             return None
       
-    def _get_camera_list(self, assets_json):
+    def _get_service_slug(self, camera_name, product_name):
         '''
-        Function to get the camera list
+        Function to get the service slug and data inventory for a product
         '''
-        # Collecting camera names
-        camera_names = [asset['data']['common']['label'] for asset in assets_json['results']]
+        service_slug = self._find_service_slug(camera_name, product_name)
+        inventory_json = self._cached('inventory', service_slug, lambda: self._fetch_inventory(service_slug, self.api_base_url, self.HEADERS))
+        inventory = self._parse_inventory(inventory_json)
 
-        # Create pandas dataframe
-        df_cams = pd.DataFrame(camera_names, columns=['Camera Name'])
+        return service_slug, inventory
 
-        # Return the dataframe
-        return df_cams
-     
-    def _get_camera_feeds(self, camera_name, assets_json):
+    def _fetch_inventory(self, service_slug, api_base_url, HEADERS):
         '''
-        Function to get the camera feeds for a specific camera
+        Function to query the webcoos API for the data inventory of a service
         '''
-        for asset in assets_json['results']:
-            if asset['data']['common']['label'] == camera_name:
-                feeds = asset['feeds']
-                break
-        return feeds
+        #Get the data inventory information for the service slug
+        inv_url = f"{api_base_url}/services/{service_slug}/inventory/"
+        with self._request(inv_url, url_class='inventory', headers=HEADERS) as response:
+            # Check the status code of the response and grab the inventory 
+            if response.status_code != 200:
+                # Print error information and raise if the request was not successful
+                logging.error(f"Failed to retrieve inventory: {response.status_code} {response.text}")
+                response.raise_for_status()
+            return response.json()
 
-    def _get_camera_products(self, feed_name, feeds, camera_name):
+    def _get_elements(self, service_slug, start_time, end_time, interval_minutes, api_base_url, HEADERS, stream=False,
+                      inventory=None, query_workers=1, tables=False):
         '''
-        Function to get the camera products available for that camera and feed
+        Function to create and view the download urls or elements. Returns an ElementTable of the filtered
+        elements. If stream is True, a generator is returned instead that yields the filtered elements (as
+        Element tuples, or as an ElementTable per page if tables is True) as each page arrives, while the next
+        page is fetched in the background. If an inventory is given and query_workers > 1, the time range is
+        split into sub-windows that are queried in parallel (see _plan_queries); elements are still returned
+        in timestamp order.
         '''
-        for feed in feeds:
-            if feed['data']['common']['label'] == feed_name:
-                products = feed['products']
-        return products
-                        
-    def _get_service_slug(self, product_name, products, feed_name, camera_name, api_base_url, HEADERS):
+        if inventory is not None and query_workers > 1:
+            windows = self._plan_queries(inventory, start_time, end_time, query_workers)
+            pages = self._iter_window_pages(service_slug, windows, query_workers, api_base_url, HEADERS)
+        else:
+            pages = self._iter_pages(service_slug, start_time, end_time, api_base_url, HEADERS)
+        page_tables = self._sample_pages(pages, interval_minutes)
+        if not stream:
+            from .elements import ElementTable
+            return ElementTable.concat(page_tables)
+        if tables:
+            return page_tables
+        return self._iter_elements(page_tables)
+
+    def _iter_elements(self, page_tables):
         '''
-        Function to get the service slug and print data inventory
+        Generator of the filtered elements, page by page
         '''
-        # go through and find the service_slug for the desired product
-        for product in products:
-            if product['data']['common']['label'] == product_name:
-                logging.info(f"Services for camera '{camera_name}', feed '{feed_name}' and product '{product_name}':")
-                services = product['services']
-                for service in services:
-                    service_slug = service['data']['common']['slug']
-                    logging.info(service_slug)  # Printing the service slug
-                break
+        for table in page_tables:
+            yield from table
 
-        #Get the data inventory information for the service slug
-        inv_url = f"{api_base_url}/services/{service_slug}/inventory/"
-        response = requests.get(inv_url, headers=HEADERS)
+    def _plan_queries(self, inventory, start_time, end_time, n_windows):
+        '''
+        Function to split [start_time, end_time] into at most n_windows (start, end) ISO sub-windows using the
+        inventory bins. Bins without data are skipped at the window edges and the windows hold roughly
+        equal element counts. The windows are half-open: each stops 1 microsecond before the next one starts
+        (the queries' bounds are inclusive), so no element is in two windows. The last one includes its stop.
+        '''
+        start = self._parse_iso(start_time)
+        end = self._parse_iso(end_time)
+        rows = [(row['Bin Start'], row['Has Data?'], row['Bin End'], row['Count']) for row in inventory]
+        last_bin_end = max(self._parse_iso(row[2]) for row in rows) if rows else None
 
-        # Check the status code of the response and grab the inventory 
-        if response.status_code == 200:
-            # Grab the response JSON for the inventory
-            inventory_json = response.json()
-        else:
-            # Print error information if the request was not successful
-            logging.error(f"Failed to retrieve assets: {response.status_code} {response.text}")
+        # Keep the bins that overlap the request and have data. The latest bin is always kept since
+        # data may have arrived after the inventory was computed (or cached) #
+        bins = []
+        for bin_start, has_data, bin_end, count in rows:
+            bin_start = self._parse_iso(bin_start)
+            bin_end = self._parse_iso(bin_end)
+            if bin_end < start or bin_start > end or (start < end and (bin_start == end or bin_end == start)):
+                continue
+            count = count or 0
+            if has_data or count > 0 or bin_end == last_bin_end:
+                # Bins cut by the request bounds count in proportion to how much of them is requested #
+                clipped_start = max(bin_start, start)
+                clipped_end = min(bin_end, end)
+                if bin_end > bin_start:
+                    count = count * (clipped_end - clipped_start) / (bin_end - bin_start)
+                bins.append((clipped_start, clipped_end, count))
+        bins.sort()
+        if not bins:
+            logging.info("Inventory has no data in the requested range, no queries needed.")
+            return []
 
-        #Put the data inventory into a dataframe for further analsyis and to provide some basic summary stats
-        inventory_data = inventory_json['results'][0]['values']
-        df_inv = pd.DataFrame(inventory_data, columns=['Bin Start', 'Has Data?', 'Bin End', 'Count', 'Bytes', 'Data Start', 'Data End'])
+        # Close a window each time it holds its share of the elements #
+        target = sum(b[2] for b in bins) / n_windows
+        windows = []
+        window_start = None
+        n_in_window = 0
+        for bin_start, bin_end, count in bins:
+            if window_start is None:
+                window_start = bin_start
+            n_in_window += count
+            if n_in_window >= target and len(windows) < n_windows - 1:
+                windows.append((window_start, bin_end))
+                window_start = None
+                n_in_window = 0
+        if window_start is not None:
+            windows.append((window_start, bins[-1][1]))
+        step = datetime.timedelta(microseconds=1)
+        windows = [(w0, windows[i + 1][0] - step if i + 1 < len(windows) else w1) for i, (w0, w1) in enumerate(windows)]
+        logging.info(f"Split query into {len(windows)} windows")
+        return [(w0.isoformat(), w1.isoformat()) for w0, w1 in windows]
 
-        return service_slug, df_inv
-    
-    def _get_elements(self, service_slug, start_time, end_time, interval_minutes, api_base_url, HEADERS):
+    def _iter_window_pages(self, service_slug, windows, query_workers, api_base_url, HEADERS):
         '''
-        Function to create and view the download urls or elements
+        Generator of an ElementTable per page of each window, window by window, with up to query_workers
+        windows queried at once. The windows must not overlap (see _plan_queries). Pages are handed over as
+        they arrive, and each window being queried holds at most WINDOW_PAGE_BUFFER pages ahead of the consumer.
         '''
+        done = object()
+        closed = threading.Event()
+        pages = [queue.Queue(maxsize=WINDOW_PAGE_BUFFER) for window in windows]
+
+        def put(i, item):
+            # Give up once the consumer has gone, so the workers don't block forever #
+            while not closed.is_set():
+                try:
+                    pages[i].put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch(i, start_time, end_time):
+            if closed.is_set():
+                return
+            try:
+                for table in self._iter_pages(service_slug, start_time, end_time, api_base_url, HEADERS):
+                    if not put(i, table.sort()):
+                        return
+            except Exception as e:
+                put(i, e)
+            else:
+                put(i, done)
 
+        with ThreadPoolExecutor(max_workers=query_workers) as executor:
+            try:
+                for i, (w0, w1) in enumerate(windows):
+                    _submit(executor, fetch, i, w0, w1)
+                for window_pages in pages:
+                    for item in iter(window_pages.get, done):
+                        if isinstance(item, Exception):
+                            raise item
+                        yield item
+            finally:
+                closed.set()
+
+    def _iter_pages(self, service_slug, start_time, end_time, api_base_url, HEADERS):
+        '''
+        Generator of an ElementTable of the elements on each page of an elements query. The next page is
+        requested while the current one is being consumed.
+        '''
+        from .elements import ElementTable
         params = {
             'starting_after': start_time,
             'starting_before': end_time,
@@ -239,99 +1043,327 @@ class API():
 
         #Set the base_url now to avoid including elements in the paginated urls
         base_url = f'{api_base_url}/elements/'
-        all_elements = []
+        n_elements = 0
         page = 1
 
-        #Run through the response for each page, adding to all_elements with the additional results and print updates to the screen
-        while True:
-            logging.info(f"Fetching page: {page}")
-            response = requests.get(base_url, headers=HEADERS, params=params)
+        #Run through the response for each page, fetching the next page before handing back the current one
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = _submit(executor, self._fetch_page, base_url, params, page, HEADERS)
+            while future is not None:
+                data = future.result()
+                n_elements += len(data['results'])
+                logging.info(f"Received {len(data['results'])} elements, total elements collected: {n_elements}")
+
+                # Request the next page or stop if there are no more pages
+                next_url = data.get('pagination', {}).get('next')
+                if next_url:
+                    page += 1
+                    # params are not passed again so subsequent requests don't duplicate parameters
+                    future = _submit(executor, self._fetch_page, next_url, None, page, HEADERS)
+                else:
+                    logging.info("No more pages.")
+                    future = None
+                yield ElementTable.from_json(data['results'])
+
+    def _fetch_page(self, url, params, page, HEADERS):
+        '''
+        Function to fetch one page of elements
+        '''
+        logging.info(f"Fetching page: {page}")
+        with self._request(url, url_class='elements', headers=HEADERS, params=params) as response:
             if response.status_code != 200:
+                # Raise rather than return a partial list of elements #
                 logging.error(f"Failed to fetch page {page}: {response.status_code}")
-                break
+                response.raise_for_status()
             data = response.json()
-            all_elements.extend(data['results'])
-            logging.info(f"Received {len(data['results'])} elements, total elements collected: {len(all_elements)}")
+        self._count(pages=1, elements=len(data['results']))
+        return data
 
-            # Update the URL for the next request or break the loop if no more pages
-            next_url = data.get('pagination', {}).get('next')
-            if not next_url:
-                logging.info("No more pages.")
-                break
-            base_url = next_url
-            params = None  # Ensure subsequent requests don't duplicate parameters
-            page += 1
-
-        # Now use the interval_minutes specified to filter the returned elements to only grab the images on certain intervals
-        filtered_elements = []
-        logging.info("Timestamps of filtered elements")
-        for element in all_elements:
-            timestamp_str = element['data']['extents']['temporal']['min']
-            timestamp = datetime.datetime.fromisoformat(timestamp_str)
-            if timestamp.minute % interval_minutes == 0:
-                filtered_elements.append(element)
-                logging.info(timestamp)
-        return filtered_elements
+    def _sample_pages(self, pages, interval_minutes):
+        '''
+        Generator of the sampled elements of each page, with the sampler's state carried from page to page
+        '''
+        from .sampling import as_sampler
+        stream = as_sampler(interval_minutes).stream()
+        for table in pages:
+            sampled = stream.feed(table)
+            logging.info(f"Kept {len(sampled)} of {len(table)} elements")
+            if len(sampled):
+                yield sampled
+        sampled = stream.flush()
+        if len(sampled):
+            yield sampled
 
-    def _download_imagery(self, filtered_elements, save_dir):
+    def _download_imagery(self, filtered_elements, save_dir, max_workers=1, chunk_size=CHUNK_SIZE, executor=None,
+                          camera_name=None, product_name=None, completed=None):
         '''
-        Function to download the data.
+        Function to download the data. filtered_elements can be any iterable of elements, including the
+        generator returned by _get_elements(stream=True), in which case files start downloading while later
+        pages are still being listed. Files are downloaded with executor if one is given. save_dir is a
+        directory or a sinks.Sink, which stores the files under camera_name and product_name. If the download
+        fails, the files in place by then are added to the completed list, if one is given.
         '''
+        if executor is None and max_workers > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                return self._download_imagery(filtered_elements, save_dir, max_workers, chunk_size, executor,
+                                              camera_name, product_name, completed)
 
-        #Now generate the download ulrs for the images
-        download_urls = []
-        for element in filtered_elements:
-            try:
-                download_url = element['data']['properties']['url']
-                download_urls.append(download_url)
-            except KeyError:
-                logging.error("Unexpected element structure:", element)
+        if isinstance(save_dir, Sink):
+            return self._download_to_sink(filtered_elements, save_dir, camera_name, product_name, max_workers,
+                                          chunk_size, executor, completed)
 
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
 
         logging.info("Beginning imagery download")
         filenames = []
-        for url in download_urls:
-            filename = os.path.join(save_dir, os.path.basename(url)).replace(':','')
-            filenames.append(filename)
-            response = requests.get(url, stream=True)
-            response.raise_for_status()  # Raise an exception for HTTP errors
-            logging.info('Downloading')
-            
-            if not os.path.exists(filename):
-                with open(filename, 'wb') as file:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        file.write(chunk)
-                logging.info('Download complete')
-        logging.info(f"Download complete. Downloaded {len(download_urls)} images to {save_dir}")
+        n_downloaded = 0
+        futures = []
+        try:
+            if executor is not None:
+                for url, filename, size, exists in self._iter_downloads(filtered_elements, save_dir):
+                    filenames.append(filename)
+                    if not exists:
+                        futures.append(_submit(executor, self._download_file, url, filename, size, chunk_size))
+                # Re-raise any exception raised in a worker #
+                for future in futures:
+                    future.result()
+                n_downloaded = len(futures)
+            else:
+                for url, filename, size, exists in self._iter_downloads(filtered_elements, save_dir):
+                    filenames.append(filename)
+                    if not exists:
+                        self._download_file(url, filename, size, chunk_size)
+                        n_downloaded += 1
+        except Exception:
+            if completed is not None:
+                # Let the files already being fetched finish, so the ones in place are known #
+                wait(futures)
+                completed.extend(filename for filename in filenames if os.path.exists(filename))
+            raise
+        logging.info(f"Download complete. Downloaded {n_downloaded} of {len(filenames)} images to {save_dir}")
 
         return filenames
-   
-    def _local2ISO(self, local_time, camera_name):
-        # Get the camera's time zone #
-        i_camera = int(np.where(self.cameras['Camera Name'] == camera_name)[0])      
-        try:  # Cameras should have a timezone field in their asset lists #
-            self.tz = self.assets_json['results'][i_camera]['data']['properties']['timezone']
-        except KeyError:  # If a camera doesn't have a timezone field, try to derive it from the name of the camera (looks for a ', CA' type abbrev in the name) #
-            try:  # If a camera doesn't have a timezone field, try to derive it from the name of the camera (looks for a ', CA' type abbrev in the name) #
-                self.tz = timezones.from_name(camera_name)
-            except ValueError:  # If both methods fail, default to UTC and warn the user #
-                self.tz = 'UTC'
-                logging.warning('Timezone of camera could not be detected or derived, defaulting to UTC.')
+
+    def _download_to_sink(self, filtered_elements, sink, camera_name, product_name, max_workers=1,
+                          chunk_size=CHUNK_SIZE, executor=None, completed=None):
+        '''
+        Function to download the elements not yet in a sink into it. Returns the location of each element, in
+        element order. Sinks with one file per element get the files written in place (with executor, if
+        given); sinks that pack elements into shards get the bytes, fetched ahead by max_workers threads.
+        If the download fails, the locations stored by then are added to the completed list, if one is given.
+        '''
+        logging.info(f"Beginning imagery download to {sink}")
+        locations = []
+
+        def missing():
+            # (index in locations, element, filename) of the elements still to be stored, in element order #
+            for element in filtered_elements:
+                location = sink.location(element)
+                filename = None if sink.sharded else sink.path(camera_name, product_name, element)
+                if location is None and filename is not None and os.path.exists(filename):
+                    # Written before the sink kept an index #
+                    location = sink.add(camera_name, product_name, element, filename, os.path.getsize(filename))
+                locations.append(location)
+                if location is None:
+                    yield len(locations) - 1, element, filename
+
+        def fetch(element, filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            self._download_file(element.url, filename, element.size, chunk_size)
+            return sink.add(camera_name, product_name, element, filename, os.path.getsize(filename))
+
+        n_downloaded = 0
+        futures = []
+        try:
+            if sink.sharded:
+                # Shards are written in element order from this thread, while files are fetched ahead #
+                slots = deque()
+
+                def queue():
+                    for i, element, filename in missing():
+                        slots.append(i)
+                        yield element
+
+                for timestamp, element, data in self._iter_fetched(queue(), max_workers, SINK_BUFFER_BYTES, True, chunk_size,
+                                                                   executor):
+                    locations[slots.popleft()] = sink.write(camera_name, product_name, element, data)
+                    n_downloaded += 1
+            elif executor is not None:
+                futures = [(i, _submit(executor, fetch, element, filename)) for i, element, filename in missing()]
+                for i, future in futures:
+                    locations[i] = future.result()
+                n_downloaded = len(futures)
             else:
-                logging.info('Camera timezone could not be detected, but was derived from camera name')
+                for i, element, filename in missing():
+                    locations[i] = fetch(element, filename)
+                    n_downloaded += 1
+        except Exception:
+            if completed is not None:
+                # Let the files already being fetched finish, so the ones stored are known #
+                wait([future for i, future in futures])
+                for i, future in futures:
+                    if future.exception() is None:
+                        locations[i] = future.result()
+                completed.extend(location for location in locations if location is not None)
+            raise
+        finally:
+            sink.flush()
+        logging.info(f"Download complete. Downloaded {n_downloaded} of {len(locations)} images to {sink}")
+        return locations
+
+    def _download_file(self, url, filename, size=None, chunk_size=CHUNK_SIZE):
+        '''
+        Function to download a single file using the shared session. The file is written to filename + '.part',
+        resuming from the end of an existing .part file with a Range request, and renamed to filename once its
+        size has been checked. Transfers interrupted part way through are resumed up to self.retry.retries times.
+        '''
+        part_filename = filename + '.part'
+        attempt = 0
+        while True:
+            try:
+                size = self._download_part(url, part_filename, size, chunk_size)
+                break
+            except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError) as e:
+                if attempt >= self.retry.retries:
+                    raise
+                logging.warning(f"Download of {url} was interrupted ({e}), resuming")
+                time.sleep(self.retry.delay(attempt))
+                attempt += 1
+
+        self._finish_download(part_filename, filename, size)
+        self._count(files=1)
+        logging.info('Download complete')
+
+    def _download_part(self, url, part_filename, size, chunk_size):
+        '''
+        Function to download the rest of a file into its .part file. Returns the expected size of the file,
+        or None if it is not known.
+        '''
+        offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else None
+        if offset:
+            logging.info(f'Resuming download from byte {offset}')
         else:
-            logging.info('Camera timezone detected')
-                
-        # Get the full datetime object and assign time zone #
-        dt_local = datetime.datetime(int(local_time[0:4]),
-                                     int(local_time[4:6]),
-                                     int(local_time[6:8]),
-                                     int(local_time[8:10]),
-                                     int(local_time[10:12]))
-        dt_local = pytz.timezone(self.tz).localize(dt_local)
-        # Convert to UTC and make ISO #
-        dt_utc = dt_local.astimezone(pytz.timezone('UTC'))
-        ISO = dt_utc.isoformat()
-        return ISO
+            logging.info('Downloading')
+
+        with self._request(url, stream=True, headers=headers) as response:
+            action, size = self._resume_action(response.status_code, response.headers, offset, size)
+            if action == 'done':
+                return size
+            if action != 'restart':
+                response.raise_for_status()  # Raise an exception for HTTP errors
+                with open(part_filename, 'ab' if action == 'append' else 'wb') as file:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        file.write(chunk)
+        if action == 'restart':
+            logging.warning(f"{part_filename} can't be resumed, downloading it again")
+            os.remove(part_filename)
+            return self._download_part(url, part_filename, size, chunk_size)
+        return size
+
+    @contextlib.contextmanager
+    def _request(self, url, url_class='file', **kwargs):
+        '''
+        Context manager to make a GET request through the shared session. Connection errors and retryable
+        statuses are retried as set by self.retry, honouring any Retry-After header, and the number of requests
+        in flight is kept under the adaptive limit. The response is closed on exit. Each attempt is reported
+        to the hooks and the stats of the running call under url_class.
+        '''
+        kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+        attempt = 0
+        while True:
+            retry_after = None
+            with self._limiter.slot(), self._host_slot(url):
+                info = self._request_started(url, url_class, attempt)
+                try:
+                    response = self.session.get(url, **kwargs)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    self._request_ended(info, None, e)
+                    if attempt >= self.retry.retries:
+                        raise
+                    logging.warning(f"Request to {url} failed ({e}), retrying")
+                    self._limiter.throttled()
+                else:
+                    if not self.retry.should_retry(response.status_code) or attempt >= self.retry.retries:
+                        if response.status_code < 500 and response.status_code != 429:
+                            self._limiter.succeeded()
+                        error = None
+                        try:
+                            yield response
+                        except BaseException as e:
+                            error = e
+                            raise
+                        finally:
+                            response.close()
+                            self._request_ended(info, response, error)
+                        return
+                    logging.warning(f"Request to {url} returned {response.status_code}, retrying")
+                    self._limiter.throttled()
+                    retry_after = response.headers.get('Retry-After')
+                    response.close()
+                    self._request_ended(info, response, None)
+            # Wait without holding a slot so other requests can go ahead #
+            time.sleep(self.retry.delay(attempt, retry_after))
+            attempt += 1
+
+    def add_hook(self, hook):
+        '''
+        Function to add an instrumentation hook. A hook is any object with some of these methods, which are
+        called from the thread making the request:
+            on_request_start(info) and on_request_end(info), with a stats.RequestInfo for each HTTP request.
+            on_stats(stats), with the stats.RunStats of each finished API call.
+        '''
+        self.hooks.append(hook)
+
+    def _emit(self, event, arg):
+        for hook in self.hooks:
+            callback = getattr(hook, event, None)
+            if callback is not None:
+                try:
+                    callback(arg)
+                except Exception:
+                    logging.exception(f"Instrumentation hook {event} failed")
+
+    def _request_started(self, url, url_class, attempt):
+        info = RequestInfo(url, url_class, attempt)
+        self._emit('on_request_start', info)
+        return info
+
+    def _request_ended(self, info, response, error):
+        info.latency = time.perf_counter() - info.start
+        info.error = error
+        if response is not None:
+            info.status = response.status_code
+            try:  # Bytes read off the wire, including bodies that were streamed #
+                info.bytes = response.raw.tell()
+            except AttributeError:
+                info.bytes = len(response.content or b'')
+        if self._stats is not None:
+            self._stats.add_request(info)
+        self._emit('on_request_end', info)
+
+    @property
+    def _stats(self):
+        '''
+        The RunStats of the call running in this thread (or whose worker this is), or None.
+        '''
+        call = _call.get()
+        return call.stats if call is not None and call.api is self else None
+
+    def _count(self, **counts):
+        '''
+        Function to add pages, elements or files to the stats of the running call.
+        '''
+        if self._stats is not None:
+            self._stats.add(**counts)
+
+    def _host_slot(self, url):
+        '''
+        Function to get a context manager that holds one of the connections allowed to the url's host, if
+        a per-host limit is in place.
+        '''
+        call = _call.get()
+        if call is None or call.api is not self or call.host_limits is None:
+            return contextlib.nullcontext()
+        return call.host_limits.slot(url)
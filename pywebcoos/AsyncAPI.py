@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio version of the WebCOOS API client.
+"""
+
+import asyncio
+import contextlib
+import logging
+import os
+
+try:
+    import aiohttp
+except ImportError:  # aiohttp is only needed for the asyncio client #
+    aiohttp = None
+
+from .API import API_BASE_URL, CHUNK_SIZE, REQUEST_TIMEOUT
+from .base import BaseAPI
+from .retry import RetryPolicy
+from .sinks import Sink
+
+
+class AsyncAPI(BaseAPI):
+
+    def __init__(self, token, verbose=False, max_connections=100, retry=None, api_base_url=API_BASE_URL):
+        '''
+        Class to interface with the WebCOOS API from an asyncio event loop. It has the core methods of API
+        (get_cameras, get_products, get_inventory and download), which must be awaited; the other API methods
+        are only available on API. Requires aiohttp.
+        
+        args:
+        _ _ _ _ _ _ 
+        token : str
+            Your WebCOOS API access token.
+        verbose : bool, optional
+            Whether or not to make the API calls verbose in their output. If True, relevant logging
+            messages will be shown. If False, only error logging messages will be shown.
+            Default is False.
+        max_connections : int, optional
+            Maximum number of open connections shared by all requests made with this client.
+            Default is 100.
+        retry : RetryPolicy, optional
+            How requests that fail with a connection error or a retryable status (e.g. 429, 503) are retried.
+            Default is None (RetryPolicy() defaults).
+        api_base_url : str, optional
+            Base URL of the API, e.g. to point at a local mock server. Default is the WebCOOS API.
+        
+        Example usage:
+        _ _ _ _ _ _ 
+        async with AsyncAPI(token) as api:
+            print(await api.get_cameras())
+            fnames = await api.download('Charleston Harbor, SC', 'one-minute-stills', 202401011200, 202401011300, 1, '.')
+        '''
+        if aiohttp is None:
+            raise ImportError('AsyncAPI requires aiohttp. Install it with: pip install aiohttp')
+        self._setup(token, verbose, api_base_url)
+        self.max_connections = max_connections
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.assets_json = None
+        self._cameras = None
+        self.cache = None
+        self.session = None
+        self._assets_lock = None
+
+    async def __aenter__(self):
+        await self._load_assets()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        '''
+        Function to close the underlying HTTP session.
+        '''
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def refresh(self):
+        '''
+        Function to re-download the assets json.
+        '''
+        self.assets_json = None
+        await self._load_assets()
+
+    async def get_cameras(self):
+        await self._load_assets()
+        return BaseAPI.get_cameras(self)
+
+    async def get_products(self, camera_name):
+        '''
+        Function to view the available products at a camera.
+        '''
+        await self._load_assets()
+        return BaseAPI.get_products(self, camera_name)
+
+    async def get_inventory(self, camera_name, product_name):
+        '''
+        Function to view available data for a product at a camera.
+        '''
+        await self._load_assets()
+        self._check_camera_name(camera_name)
+        self._check_product_name(camera_name, product_name)
+
+        service_slug, inventory = await self._get_service_slug(camera_name, product_name)
+        return self._get_inventory_range(inventory)
+
+    async def download(self, camera_name, product_name, start, stop, interval, save_dir, max_workers=10, chunk_size=CHUNK_SIZE):
+        '''
+        Function to download imagery. Up to max_workers files are downloaded at once.
+        '''
+        if isinstance(save_dir, Sink):
+            raise ValueError('AsyncAPI.download saves to a directory; use API.download to write to a sink.')
+        start = str(start)
+        stop = str(stop)
+
+        await self._load_assets()
+        self._check_download_args(camera_name, product_name, start, stop)
+        from .sampling import as_sampler
+        interval = as_sampler(interval)
+        start = self._local2ISO(start, camera_name)
+        stop = self._local2ISO(stop, camera_name)
+
+        service_slug, inventory = await self._get_service_slug(camera_name, product_name)
+        self._check_date_bounds(start, stop, self._get_inventory_range(inventory))
+        filtered_elements = await self._get_elements(service_slug, start, stop, interval)
+        filenames = await self._download_imagery(filtered_elements, save_dir, max_workers, chunk_size)
+        return filenames
+
+    def _ensure_assets(self):
+        # The coroutines load the assets json (see _load_assets) before the catalog is used #
+        if self.assets_json is None:
+            raise RuntimeError('The assets json is not loaded yet; await a method of the client first.')
+
+    async def _get_session(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    @contextlib.asynccontextmanager
+    async def _request(self, url, **kwargs):
+        '''
+        Async context manager to make a GET request, retrying connection errors and retryable statuses as
+        set by self.retry and honouring any Retry-After header.
+        '''
+        session = await self._get_session()
+        kwargs.setdefault('timeout', aiohttp.ClientTimeout(sock_connect=REQUEST_TIMEOUT[0], sock_read=REQUEST_TIMEOUT[1]))
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                response = await session.get(url, **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt >= self.retry.retries:
+                    raise
+                logging.warning(f"Request to {url} failed ({e}), retrying")
+            else:
+                if not self.retry.should_retry(response.status) or attempt >= self.retry.retries:
+                    try:
+                        yield response
+                    finally:
+                        response.release()
+                    return
+                logging.warning(f"Request to {url} returned {response.status}, retrying")
+                retry_after = response.headers.get('Retry-After')
+                response.release()
+            await asyncio.sleep(self.retry.delay(attempt, retry_after))
+            attempt += 1
+
+    async def _load_assets(self):
+        '''
+        Function to fetch the assets json the first time it is needed.
+        '''
+        if self._assets_lock is None:
+            self._assets_lock = asyncio.Lock()
+        async with self._assets_lock:
+            if self.assets_json is not None:
+                return
+            async with self._request(f"{self.api_base_url}/assets/", headers=self.HEADERS) as response:
+                if response.status == 200:
+                    assets_json = await response.json()
+                else:
+                    logging.error(f"Failed to retrieve assets: {response.status} {await response.text()}")
+                    if response.status in self.retry.statuses:
+                        response.raise_for_status()
+                    raise ValueError('API access token is not valid.')
+            self._set_assets(assets_json)
+
+    async def _get_service_slug(self, camera_name, product_name):
+        '''
+        Function to get the service slug and the data inventory
+        '''
+        service_slug = self._find_service_slug(camera_name, product_name)
+
+        inv_url = f"{self.api_base_url}/services/{service_slug}/inventory/"
+        async with self._request(inv_url, headers=self.HEADERS) as response:
+            if response.status != 200:
+                logging.error(f"Failed to retrieve inventory: {response.status} {await response.text()}")
+                response.raise_for_status()
+            inventory_json = await response.json()
+        return service_slug, self._parse_inventory(inventory_json)
+
+    async def _get_elements(self, service_slug, start_time, end_time, interval_minutes):
+        '''
+        Function to get the elements for a service, filtered to the interval, as an ElementTable
+        '''
+        from .elements import ElementTable
+        params = {
+            'starting_after': start_time,
+            'starting_before': end_time,
+            'service': service_slug
+        }
+        base_url = f'{self.api_base_url}/elements/'
+        tables = []
+        n_elements = 0
+        page = 1
+
+        while True:
+            logging.info(f"Fetching page: {page}")
+            async with self._request(base_url, headers=self.HEADERS, params=params) as response:
+                if response.status != 200:
+                    logging.error(f"Failed to fetch page {page}: {response.status}")
+                    response.raise_for_status()
+                data = await response.json()
+            tables.append(ElementTable.from_json(data['results']))
+            n_elements += len(data['results'])
+            logging.info(f"Received {len(data['results'])} elements, total elements collected: {n_elements}")
+
+            next_url = data.get('pagination', {}).get('next')
+            if not next_url:
+                logging.info("No more pages.")
+                break
+            base_url = next_url
+            params = None
+            page += 1
+
+        return self._filter_elements(ElementTable.concat(tables), interval_minutes)
+
+    async def _download_imagery(self, filtered_elements, save_dir, max_workers=10, chunk_size=CHUNK_SIZE):
+        '''
+        Function to download the data.
+        '''
+        filenames, pending = self._plan_downloads(filtered_elements, save_dir)
+
+        logging.info("Beginning imagery download")
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def fetch(url, filename, size):
+            async with semaphore:
+                await self._download_file(url, filename, size, chunk_size)
+
+        await asyncio.gather(*[fetch(url, filename, size) for url, filename, size in pending])
+        logging.info(f"Download complete. Downloaded {len(pending)} of {len(filenames)} images to {save_dir}")
+        return filenames
+
+    async def _download_file(self, url, filename, size=None, chunk_size=CHUNK_SIZE):
+        '''
+        Function to download a single file, as API._download_file does.
+        '''
+        part_filename = filename + '.part'
+        attempt = 0
+        while True:
+            try:
+                size = await self._download_part(url, part_filename, size, chunk_size)
+                break
+            except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt >= self.retry.retries:
+                    raise
+                logging.warning(f"Download of {url} was interrupted ({e}), resuming")
+                await asyncio.sleep(self.retry.delay(attempt))
+                attempt += 1
+
+        self._finish_download(part_filename, filename, size)
+        logging.info('Download complete')
+
+    async def _download_part(self, url, part_filename, size, chunk_size):
+        '''
+        Function to download the rest of a file into its .part file, as API._download_part does.
+        '''
+        offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else None
+        if offset:
+            logging.info(f'Resuming download from byte {offset}')
+        else:
+            logging.info('Downloading')
+
+        async with self._request(url, headers=headers) as response:
+            action, size = self._resume_action(response.status, response.headers, offset, size)
+            if action == 'done':
+                return size
+            if action != 'restart':
+                response.raise_for_status()
+                with open(part_filename, 'ab' if action == 'append' else 'wb') as file:
+                    async for chunk in response.content.iter_chunked(chunk_size):
+                        file.write(chunk)
+        if action == 'restart':
+            logging.warning(f"{part_filename} can't be resumed, downloading it again")
+            os.remove(part_filename)
+            return await self._download_part(url, part_filename, size, chunk_size)
+        return size
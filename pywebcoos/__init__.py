@@ -1 +1,11 @@
 from .API import API
+from .retry import RetryPolicy
+
+
+def __getattr__(name):
+    # AsyncAPI (and aiohttp) are only imported when first used #
+    if name == 'AsyncAPI':
+        from .AsyncAPI import AsyncAPI
+        globals()['AsyncAPI'] = AsyncAPI
+        return AsyncAPI
+    raise AttributeError(f"module 'pywebcoos' has no attribute {name!r}")
@@ -0,0 +1,345 @@
+"""
+Logic shared by the sync and asyncio clients that makes no requests: argument checks, the camera catalog,
+inventory parsing, time conversion and element filtering.
+"""
+
+import datetime
+import logging
+import os
+
+import pytz
+
+from . import timezones
+
+
+# Columns of each row of a product inventory #
+INVENTORY_COLUMNS = ['Bin Start', 'Has Data?', 'Bin End', 'Count', 'Bytes', 'Data Start', 'Data End']
+
+
+class BaseAPI():
+    '''
+    Base class of API and AsyncAPI. Subclasses make the requests, and provide _ensure_assets(), which makes
+    sure the assets json has been loaded (with _set_assets) before the catalog is used.
+    '''
+
+    def _set_assets(self, assets_json):
+        '''
+        Function to store the assets json along with the catalog built from it. The camera list dataframe
+        is only built when it is asked for (see cameras).
+        '''
+        self._catalog = self._build_catalog(assets_json)
+        self._timezones = {}
+        self._cameras = None
+        self.assets_json = assets_json
+
+    def _setup(self, token, verbose, api_base_url):
+        '''
+        Function to set the logging level, base URL and request headers.
+        '''
+        # Set the logging level #
+        if verbose:
+            logging.basicConfig(level=logging.INFO)
+        else:
+            logging.basicConfig(level=logging.WARNING)
+
+        # Establish the base URL and headers for requests #
+        self.api_base_url = api_base_url.rstrip('/')
+        self.HEADERS = {
+            'Authorization': 'Token '+token,
+            'Accept': 'application/json'
+        }
+
+    @property
+    def cameras(self):
+        '''
+        The camera list dataframe, built (after loading the assets json, if need be) when first accessed.
+        '''
+        self._ensure_assets()
+        if self._cameras is None:
+            self._cameras = self._get_camera_list(self.assets_json)
+        return self._cameras
+
+    def get_cameras(self):
+        return self.cameras
+
+    def get_products(self, camera_name):
+        '''
+        Function to view the available products at a camera.
+        '''
+        self._check_camera_name(camera_name)
+        return self._get_product_labels(camera_name)
+
+    def _get_local_windows(self, start, stop):
+        '''
+        Function to get the local (start, stop) times of the windows requested by a list of (start, stop)
+        tuples or a schedule, as two datetime64[m] arrays. Returns None if start is a single date.
+        '''
+        if not (hasattr(start, 'local_windows') or isinstance(start, (list, tuple))):
+            return None
+        from . import schedule
+        if stop is not None:
+            raise ValueError('Requested stop must be None when start is a list of windows or a schedule.')
+        if isinstance(start, (list, tuple)):
+            for window in start:
+                if len(window) != 2:
+                    raise ValueError('Requested windows must be (start, stop) pairs.')
+                self._check_date_format(str(window[0]), 'start')
+                self._check_date_format(str(window[1]), 'stop')
+            start = schedule.Windows(start)
+        starts, stops = start.local_windows()
+        if (stops < starts).any():
+            raise ValueError('Requested windows must not stop before they start.')
+        return starts, stops
+
+    def _check_camera_name(self, camera_name):
+        self._ensure_assets()
+        if camera_name not in self._catalog:
+            raise ValueError('Camera is not an available WebCOOS camera.')
+
+    def _check_product_name(self, camera_name, product_name):
+        if product_name not in self._get_product_labels(camera_name):
+            raise ValueError('Requested product is not available at this camera.')
+
+    def _check_date_format(self, date, date_name):
+        if len(date) != 12:
+            raise ValueError('Requested '+date_name+' date is of improper format. Format should be yyyymmddHHMM.')
+        else:
+            try:
+                datetime.datetime(int(date[0:4]), int(date[4:6]), int(date[6:8]), int(date[8:10]), int(date[10:12]))
+            except ValueError:
+                raise ValueError('Requested '+date_name+' date is of improper format. Format should be yyyymmddHHMM.')
+
+    def _check_download_args(self, camera_name, product_name, start, stop):
+        '''
+        Function to run the input checks that do not need a network request.
+        '''
+        self._check_camera_name(camera_name)
+        self._check_product_name(camera_name, product_name)
+        self._check_date_format(start, 'start')
+        self._check_date_format(stop, 'stop')
+
+    def _check_date_bounds(self, starts, stops, dr):
+        ss = []
+        for s in [starts, stops]:
+            ss.append(datetime.datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16])))
+            
+        dtr = []
+        for d in dr:
+            dtr.append(datetime.datetime(int(d[0:4]), int(d[5:7]), int(d[8:10]), int(d[11:13]), int(d[14:16])))
+        
+        if dtr[0] <= ss[0] <= dtr[1] and dtr[0] <= ss[1] <= dtr[1]:
+            pass
+        else:
+            raise ValueError('At least one requested date bound is outside the range of available data for this product at this camera.')
+
+    def _get_camera_list(self, assets_json):
+        '''
+        Function to get the camera list
+        '''
+        # pandas is only imported when a dataframe is returned #
+        import pandas as pd
+
+        # Collecting camera names
+        camera_names = [asset['data']['common']['label'] for asset in assets_json['results']]
+
+        # Create pandas dataframe
+        df_cams = pd.DataFrame(camera_names, columns=['Camera Name'])
+
+        # Return the dataframe
+        return df_cams
+
+    def _build_catalog(self, assets_json):
+        '''
+        Function to index the assets json by camera, feed and product so lookups do not need to scan it.
+        Returns {camera_name: {'index': i, 'timezone': tz, 'feeds': {feed_name: {product_name: service_slug}}}}
+        '''
+        catalog = {}
+        for i, asset in enumerate(assets_json['results']):
+            feeds = {}
+            for feed in asset.get('feeds', []):
+                products = {}
+                for product in feed.get('products', []):
+                    service_slug = None
+                    for service in product.get('services', []):
+                        service_slug = service['data']['common']['slug']
+                    products[product['data']['common']['label']] = service_slug
+                feeds[feed['data']['common']['label']] = products
+            camera_name = asset['data']['common']['label']
+            if camera_name not in catalog:  # Keep the first asset with a given name #
+                catalog[camera_name] = {'index': i,
+                                        'timezone': asset['data'].get('properties', {}).get('timezone'),
+                                        'feeds': feeds}
+        return catalog
+
+    def _get_camera_products(self, camera_name, feed_name='raw-video-data'):
+        '''
+        Function to get the products available for a camera and feed, as a {product_name: service_slug} dict
+        '''
+        return self._catalog[camera_name]['feeds'].get(feed_name, {})
+
+    def _get_product_labels(self, camera_name):
+        '''
+        Function to get the labels of the products available at a camera
+        '''
+        return list(self._get_camera_products(camera_name))
+
+    def _find_service_slug(self, camera_name, product_name, feed_name='raw-video-data'):
+        '''
+        Function to find the service slug for a product
+        '''
+        service_slug = self._get_camera_products(camera_name, feed_name)[product_name]
+        logging.info(f"Service for camera '{camera_name}', feed '{feed_name}' and product '{product_name}': {service_slug}")
+        return service_slug
+
+    def _parse_inventory(self, inventory_json):
+        '''
+        Function to put the inventory json into a list of rows, each a dict keyed by INVENTORY_COLUMNS
+        '''
+        inventory_data = inventory_json['results'][0]['values']
+        return [dict(zip(INVENTORY_COLUMNS, row)) for row in inventory_data]
+
+    def _get_inventory_range(self, inventory):
+        '''
+        Function to get the range of dates with data from an inventory
+        '''
+        # ISO strings in the same format sort in time order #
+        min_date = min((row['Bin Start'] for row in inventory if row['Bin Start'] is not None), default=None)
+        max_date = max((row['Bin End'] for row in inventory if row['Bin End'] is not None), default=None)
+        return [min_date, max_date]
+
+    def _parse_iso(self, iso):
+        '''
+        Function to parse an ISO 8601 timestamp into a timezone-aware datetime (UTC if no offset is given)
+        '''
+        dt = datetime.datetime.fromisoformat(iso.replace('Z', '+00:00'))
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=datetime.timezone.utc)
+        return dt
+
+    def _filter_elements(self, table, interval_minutes):
+        '''
+        Function to keep only the elements of an ElementTable that fall on the requested interval, which is
+        an int number of minutes or a sampling.Sampler
+        '''
+        from .sampling import as_sampler
+        # Now use the interval_minutes specified to filter the returned elements to only grab the images on certain intervals
+        filtered = as_sampler(interval_minutes).select(table)
+        logging.info(f"Kept {len(filtered)} of {len(table)} elements")
+        return filtered
+
+    def _iter_downloads(self, filtered_elements, save_dir):
+        '''
+        Generator of (url, filename, size, exists) for each element, in element order. size is the file size
+        given in the element metadata, or None if it is not given.
+        '''
+        for element in filtered_elements:
+            filename = self._get_filename(element.url, save_dir)
+            # Files only get their final name once complete, so skip them before any request is made #
+            exists = os.path.exists(filename)
+            if exists:
+                logging.info(f"Skipping {filename}, file already exists")
+            yield element.url, filename, element.size, exists
+
+    def _get_filename(self, url, save_dir):
+        '''
+        Function to get the local filename of a file url
+        '''
+        return os.path.join(save_dir, os.path.basename(url)).replace(':','')
+
+    def _plan_downloads(self, filtered_elements, save_dir):
+        '''
+        Function to get the filenames for the elements, in element order, and the (url, filename, size) of the files still to download.
+        '''
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        filenames = []
+        pending = []
+        for url, filename, size, exists in self._iter_downloads(filtered_elements, save_dir):
+            filenames.append(filename)
+            if not exists:
+                pending.append((url, filename, size))
+        return filenames, pending
+
+    def _resume_action(self, status, headers, offset, size):
+        '''
+        Function to decide how to carry on a download into a .part file of offset bytes, from the status and
+        headers of the (Range) response. Returns the action and the expected size of the file (None if not
+        known): 'done' if the .part file is already complete, 'restart' if it can't be resumed and must be
+        deleted, 'append' to add the body to it or 'write' to replace it with the body.
+        '''
+        if status == 416:
+            # Content-Range is of the form 'bytes */total' #
+            total = headers.get('Content-Range', '').rpartition('/')[2]
+            total = int(total) if total.isdigit() else size
+            if total is not None and offset == total:
+                return 'done', total
+            return 'restart', size
+        if status == 206:
+            # Content-Range is of the form 'bytes start-end/total' #
+            total = headers.get('Content-Range', '').rpartition('/')[2]
+            action = 'append'
+        else:
+            # The server sent the whole file, so start the .part file again #
+            total = headers.get('Content-Length')
+            action = 'write'
+        if size is None and total and total.isdigit() and 'Content-Encoding' not in headers:
+            size = int(total)
+        return action, size
+
+    def _finish_download(self, part_filename, filename, size):
+        '''
+        Function to check the size of a downloaded .part file and atomically move it to its final name.
+        '''
+        if size is not None:
+            downloaded = os.path.getsize(part_filename)
+            if downloaded > size:  # The .part file can't be resumed, so start again next time #
+                os.remove(part_filename)
+            if downloaded != size:
+                raise IOError(f"Downloaded {downloaded} bytes of {filename} but expected {size}.")
+        os.replace(part_filename, filename)
+
+    def _get_timezone(self, camera_name):
+        '''
+        Function to get the name of a camera's time zone. It is worked out once per camera and cached.
+        '''
+        tz = self._timezones.get(camera_name)
+        if tz is not None:
+            return tz
+        tz = self._catalog[camera_name]['timezone']  # Cameras should have a timezone field in their asset lists #
+        if tz is not None:
+            logging.info('Camera timezone detected')
+        else:
+            try:  # If a camera doesn't have a timezone field, try to derive it from the name of the camera (looks for a ', CA' type abbrev in the name) #
+                tz = timezones.from_name(camera_name)
+            except ValueError:  # If both methods fail, default to UTC and warn the user #
+                tz = 'UTC'
+                logging.warning('Timezone of camera could not be detected or derived, defaulting to UTC.')
+            else:
+                logging.info('Camera timezone could not be detected, but was derived from camera name')
+        self._timezones[camera_name] = tz
+        return tz
+
+    def _local2ISO(self, local_time, camera_name):
+        # Get the full datetime object and assign time zone #
+        dt_local = datetime.datetime(int(local_time[0:4]),
+                                     int(local_time[4:6]),
+                                     int(local_time[6:8]),
+                                     int(local_time[8:10]),
+                                     int(local_time[10:12]))
+        dt_local = pytz.timezone(self._get_timezone(camera_name)).localize(dt_local)
+        # Convert to UTC and make ISO #
+        dt_utc = dt_local.astimezone(pytz.timezone('UTC'))
+        ISO = dt_utc.isoformat()
+        return ISO
+
+    def _local2UTC(self, local_times, camera_name):
+        '''
+        Function to convert an array of local datetime64 times at a camera to UTC datetime64[us] times in one go.
+        Like _local2ISO, ambiguous times are taken as standard time and times skipped by a DST change are
+        moved on by an hour.
+        '''
+        import pandas as pd
+        local_times = pd.DatetimeIndex(local_times.astype('datetime64[us]'))
+        utc = local_times.tz_localize(self._get_timezone(camera_name), ambiguous=[False] * len(local_times),
+                                      nonexistent=pd.Timedelta(hours=1)).tz_convert('UTC')
+        return utc.tz_localize(None).to_numpy().astype('datetime64[us]')
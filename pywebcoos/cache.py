@@ -0,0 +1,109 @@
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+try:  # File locking is done with fcntl on POSIX and msvcrt on Windows #
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+# Default time-to-live of each cached resource, in seconds #
+DEFAULT_TTL = {'assets': 3600,
+               'inventory': 600}
+
+
+class MetadataCache():
+
+    def __init__(self, cache_dir, ttl=None):
+        '''
+        Class to cache API metadata (the assets json and service inventories) on disk so it can be
+        shared between API objects and processes.
+        
+        args:
+        _ _ _ _ _ _ 
+        cache_dir : str
+            Directory to store the cached json in. Created if it does not exist.
+        ttl : dict, optional
+            Time-to-live in seconds per resource, e.g. {'assets': 3600, 'inventory': 600}. Resources
+            not given use the values in DEFAULT_TTL. A ttl of 0 disables caching for that resource.
+        '''
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.ttl = dict(DEFAULT_TTL)
+        if ttl is not None:
+            self.ttl.update(ttl)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get(self, resource, key, fetch):
+        '''
+        Function to return a cached resource, calling fetch() to get it if the cached copy is missing or stale.
+        Results of None are not cached. Other processes asking for the same resource wait for the fetch
+        instead of repeating it.
+        '''
+        ttl = self.ttl.get(resource, 0)
+        if ttl <= 0:
+            return fetch()
+        path = self._path(resource, key)
+        with self._lock(path):
+            data = self._read(path, ttl)
+            if data is None:
+                data = fetch()
+                if data is not None:
+                    self._write(path, data)
+        return data
+
+    def clear(self):
+        '''
+        Function to remove all cached resources.
+        '''
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith('.json'):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self.cache_dir, fname))
+
+    def _path(self, resource, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self.cache_dir, f"{resource}-{digest}.json")
+
+    def _read(self, path, ttl):
+        try:
+            with open(path, 'r') as f:
+                cached = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if time.time() - cached['fetched'] > ttl:
+            return None
+        return cached['data']
+
+    def _write(self, path, data):
+        # Write to a temporary file and rename so readers never see a partial file #
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'fetched': time.time(), 'data': data}, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+
+    @contextlib.contextmanager
+    def _lock(self, path):
+        with open(path + '.lock', 'a+b') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
@@ -0,0 +1,159 @@
+"""
+Compact columnar storage of element listings.
+"""
+
+import collections
+import datetime
+import logging
+
+import numpy as np
+
+
+# One element of a listing. timestamp is a UTC datetime and size is None if it is not known #
+Element = collections.namedtuple('Element', ['timestamp', 'url', 'size', 'id'])
+
+
+class ElementTable():
+
+    def __init__(self, times, urls, sizes, ids):
+        '''
+        Class to hold a listing of elements as typed columns instead of the element json, with one row per
+        element. Iterating over the table (or indexing it with an int) gives Element tuples, while indexing
+        it with a slice, a boolean mask or an array of indices gives another ElementTable.
+
+        args:
+        _ _ _ _ _ _
+        times : numpy.ndarray
+            datetime64[us] start times of the elements, in UTC.
+        urls : numpy.ndarray
+            object array of the file urls.
+        sizes : numpy.ndarray
+            int64 file sizes in bytes, -1 where the size is not known.
+        ids : numpy.ndarray
+            object array of the element ids.
+
+        Example usage:
+        _ _ _ _ _ _
+        table = api.list_elements('Charleston Harbor, SC', 'one-minute-stills', 202401011200, 202401011300, 1)
+        print(len(table), table.sizes.sum())
+        df = table.to_pandas()
+        '''
+        self.times = times
+        self.urls = urls
+        self.sizes = sizes
+        self.ids = ids
+
+    @classmethod
+    def from_json(cls, elements):
+        '''
+        Function to build a table from a list of element json dicts (e.g. one page of an /elements/ query).
+        Elements without a url are skipped.
+        '''
+        times, urls, sizes, ids = [], [], [], []
+        for element in elements:
+            try:
+                url = element['data']['properties']['url']
+                time = element['data']['extents']['temporal']['min']
+            except KeyError:
+                logging.error(f"Unexpected element structure: {element}")
+                continue
+            size = element['data']['properties'].get('size')
+            times.append(time)
+            urls.append(url)
+            sizes.append(-1 if size is None else size)
+            ids.append(element.get('id'))
+        return cls(_parse_times(times), _object_array(urls), np.array(sizes, dtype=np.int64), _object_array(ids))
+
+    @classmethod
+    def empty(cls):
+        return cls.from_json([])
+
+    @classmethod
+    def concat(cls, tables):
+        '''
+        Function to join tables end to end.
+        '''
+        tables = list(tables)
+        if not tables:
+            return cls.empty()
+        return cls(np.concatenate([t.times for t in tables]), np.concatenate([t.urls for t in tables]),
+                   np.concatenate([t.sizes for t in tables]), np.concatenate([t.ids for t in tables]))
+
+    def __len__(self):
+        return len(self.times)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._row(i)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self._row(key)
+        if isinstance(key, list):  # A list of bools is a mask, anything else a list of indices #
+            key = np.array(key, dtype=bool if key and isinstance(key[0], (bool, np.bool_)) else np.intp)
+        return ElementTable(self.times[key], self.urls[key], self.sizes[key], self.ids[key])
+
+    def __repr__(self):
+        return f"ElementTable({len(self)} elements)"
+
+    def _row(self, i):
+        size = int(self.sizes[i])
+        timestamp = self.times[i].item().replace(tzinfo=datetime.timezone.utc)
+        return Element(timestamp, self.urls[i], None if size < 0 else size, self.ids[i])
+
+    def interval_mask(self, interval_minutes):
+        '''
+        Function to get a boolean mask of the elements whose minute is a multiple of interval_minutes.
+        '''
+        minutes = self.times.astype('datetime64[m]').astype(np.int64) % 60
+        return minutes % interval_minutes == 0
+
+    def within(self, starts, stops):
+        '''
+        Function to keep the elements that fall in any of the windows [starts[i], stops[i]], given as sorted,
+        non-overlapping datetime64 arrays.
+        '''
+        i = np.searchsorted(starts, self.times, side='right') - 1
+        inside = (i >= 0) & (self.times <= stops[np.clip(i, 0, None)])
+        return self[inside]
+
+    def sort(self):
+        '''
+        Function to get the table sorted by time. Elements with equal times keep their order.
+        '''
+        return self[np.argsort(self.times, kind='stable')]
+
+    def to_pandas(self):
+        '''
+        Function to get the table as a dataframe with Timestamp (UTC), URL, Size and ID columns.
+        '''
+        import pandas as pd
+        sizes = pd.array(self.sizes, dtype='Int64')
+        sizes[self.sizes < 0] = pd.NA
+        return pd.DataFrame({'Timestamp': pd.to_datetime(self.times).tz_localize('UTC'), 'URL': self.urls,
+                             'Size': sizes, 'ID': self.ids})
+
+
+def _parse_times(times):
+    '''
+    Function to parse ISO times into a datetime64[us] UTC array. Times in UTC (the API's 'Z' or '+00:00')
+    are parsed by numpy in one go, others are converted one by one.
+    '''
+    naive = []
+    for time in times:
+        if time.endswith('Z'):
+            naive.append(time[:-1])
+        elif time.endswith('+00:00'):
+            naive.append(time[:-6])
+        else:
+            dt = datetime.datetime.fromisoformat(time)
+            if dt.tzinfo is not None:
+                dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            naive.append(dt.isoformat())
+    return np.array(naive, dtype='datetime64[us]')
+
+
+def _object_array(values):
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
@@ -0,0 +1,269 @@
+"""
+Decoding of downloaded stills and videos into one stack of frames, for timestacks, image averages and the
+like. The frames are decoded in a process pool and written straight into a memory-mapped .npy file, so
+stacks much larger than memory can be built:
+
+    with sinks.DirectorySink('stills') as sink:
+        api.download('Charleston Harbor, SC', 'one-minute-stills', 202401010000, 202401080000, 1, sink)
+        entries = sink.find('Charleston Harbor, SC', 'one-minute-stills')
+    stack, times = frames.stack(entries, 'week.npy', max_workers=8)
+
+Images are decoded with imageio, or Pillow if imageio is not installed, and videos with imageio (and its
+pyav plugin).
+"""
+
+import datetime
+import io
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+# Extensions of the files decoded as videos, anything else is decoded as an image #
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.mkv', '.ts', '.webm')
+# Number of images each task of the process pool decodes #
+IMAGES_PER_TASK = 32
+
+
+def stack(sources, output, timestamps=None, fps=None, max_workers=None, decoder=None):
+    '''
+    Function to decode stills and videos into one array of frames, saved as output (a .npy file) with the
+    UTC time of each frame saved beside it as output's name + '_times.npy'. Each image is one frame, and
+    each video gives its frames at fps frames per second (all of them if fps is None), timed from the
+    element's start time. Frames are stacked in the order of sources.
+
+    args:
+    _ _ _ _ _ _
+    sources : list
+        sinks.Entry tuples (e.g. from sink.find), or filenames (e.g. returned by API.download).
+    output : str
+        Filename of the .npy file to write.
+    timestamps : list or numpy.ndarray, optional
+        UTC start times of the sources, as datetimes or datetime64, e.g. the times column of
+        API.list_elements. Needed if sources are filenames, and taken from the entries otherwise.
+    fps : float, optional
+        Rate to sample video frames at. Default is None (every frame).
+    max_workers : int, optional
+        Number of processes decoding at once. Default is None (one per CPU); 1 decodes in this process.
+    decoder : callable, optional
+        Function taking a filename or the bytes of a file and returning an image array, to use instead of
+        imageio or Pillow for stills. It must be importable by the worker processes (e.g. a module level function).
+
+    returns:
+    _ _ _ _ _ _
+    The frames as a read-only memory-mapped array of shape (frames, height, width[, channels]), and their
+    times as a datetime64[us] array. Frames that could not be decoded or whose shape differs from the first
+    frame's are left as zeros and their times are NaT.
+    '''
+    sources = list(sources)
+    if timestamps is None:
+        if not all(hasattr(source, 'timestamp') for source in sources):
+            raise ValueError('timestamps are needed when sources are filenames.')
+        timestamps = [source.timestamp for source in sources]
+    starts = _to_datetime64(timestamps)
+    if len(starts) != len(sources):
+        raise ValueError('timestamps must have one time per source.')
+    if not sources:
+        raise ValueError('No sources to stack.')
+    if fps is not None and fps <= 0:
+        raise ValueError('fps must be positive.')
+
+    n_workers = max_workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+    try:
+        # Videos are probed for their length, then every source gets a block of rows of the output #
+        is_video = [_is_video(source) for source in sources]
+        videos = [source for source, video in zip(sources, is_video) if video]
+        probes = iter(_map(executor, _probe_video, videos, [fps] * len(videos)))
+        offsets = [next(probes) if video else np.zeros(1) for video in is_video]
+        rows = np.concatenate([[0], np.cumsum([len(o) for o in offsets])])
+        times = np.concatenate([start + (o * 1e6).astype('timedelta64[us]') for start, o in zip(starts, offsets)])
+        if not len(times):
+            raise ValueError('The sources have no frames.')
+
+        first = _first_frame(sources, is_video, fps, decoder)
+        logging.info(f"Stacking {len(times)} frames of shape {first.shape} from {len(sources)} sources into {output}")
+        frames = np.lib.format.open_memmap(output, mode='w+', dtype=first.dtype, shape=(len(times),) + first.shape)
+        del frames  # The workers open the file themselves #
+
+        # Images are decoded in batches, and each video on its own #
+        tasks = []
+        images = [i for i, video in enumerate(is_video) if not video]
+        for j in range(0, len(images), IMAGES_PER_TASK):
+            batch = images[j:j + IMAGES_PER_TASK]
+            tasks.append(([sources[i] for i in batch], [int(rows[i]) for i in batch], [1] * len(batch), False))
+        for i in (i for i, video in enumerate(is_video) if video):
+            tasks.append(([sources[i]], [int(rows[i])], [len(offsets[i])], True))
+        missing = []
+        for task_missing in _map(executor, _decode_task, [output] * len(tasks), *zip(*tasks),
+                                 [fps] * len(tasks), [decoder] * len(tasks)):
+            missing.extend(task_missing)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if missing:
+        logging.warning(f"{len(missing)} of {len(times)} frames could not be decoded")
+        times[missing] = np.datetime64('NaT')
+    np.save(times_filename(output), times)
+    return np.load(output, mmap_mode='r'), times
+
+
+def load(output):
+    '''
+    Function to open a stack written by stack(). Returns the memory-mapped frames and their times.
+    '''
+    return np.load(output, mmap_mode='r'), np.load(times_filename(output))
+
+
+def times_filename(output):
+    '''
+    Function to get the filename the frame times of a stack are saved to.
+    '''
+    return os.path.splitext(output)[0] + '_times.npy'
+
+
+def sample_offsets(n_frames, native_fps, fps=None):
+    '''
+    Function to get the indices and times (seconds from the start) of the frames of a video of n_frames at
+    native_fps that are kept when sampling at fps: the first frame at or after each multiple of 1 / fps.
+    '''
+    times = np.arange(n_frames) / native_fps
+    if fps is None or fps >= native_fps:
+        return np.arange(n_frames), times
+    # A frame is kept if a sample time falls after the previous frame and at or before it #
+    marks = np.floor(times * fps + 1e-9)
+    keep = np.ones(n_frames, dtype=bool)
+    keep[1:] = marks[1:] > marks[:-1]
+    return np.flatnonzero(keep), times[keep]
+
+
+def _map(executor, function, *args):
+    if executor is None:
+        return map(function, *args)
+    return executor.map(function, *args)
+
+
+def _decode_task(output, sources, rows, n_rows, is_video, fps, decoder):
+    '''
+    Function run by the workers to decode sources into their rows of the output. Returns the rows left empty.
+    '''
+    frames = np.load(output, mmap_mode='r+')
+    missing = []
+    for source, row, n in zip(sources, rows, n_rows):
+        written = 0
+        try:
+            decoded = _video_frames(source, fps) if is_video else [_read_image(source, decoder)]
+            for frame in decoded:
+                if written == n:
+                    break
+                if frame.shape != frames.shape[1:]:
+                    logging.warning(f"Frame of {_name(source)} has shape {frame.shape}, expected {frames.shape[1:]}")
+                    missing.append(row + written)
+                else:
+                    frames[row + written] = frame
+                written += 1
+        except Exception as e:
+            logging.error(f"Could not decode {_name(source)}: {e}")
+        missing.extend(range(row + written, row + n))
+    frames.flush()
+    del frames
+    return missing
+
+
+def _first_frame(sources, is_video, fps, decoder):
+    '''
+    Function to decode the first frame of the first source that has one, to get the shape and dtype of the stack.
+    '''
+    for source, video in zip(sources, is_video):
+        try:
+            if not video:
+                return np.asarray(_read_image(source, decoder))
+            for frame in _video_frames(source, fps):
+                return np.asarray(frame)
+        except Exception as e:
+            logging.error(f"Could not decode {_name(source)}: {e}")
+    raise ValueError('None of the sources could be decoded.')
+
+
+def _read_image(source, decoder=None):
+    data = _open(source)
+    if decoder is not None:
+        return np.asarray(decoder(data))
+    try:
+        import imageio.v3 as iio
+        return iio.imread(data)
+    except ImportError:
+        pass
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ImportError('Decoding images requires imageio or Pillow. Install one with: pip install imageio')
+    with Image.open(io.BytesIO(data) if isinstance(data, bytes) else data) as image:
+        return np.asarray(image)
+
+
+def _probe_video(source, fps):
+    '''
+    Function to get the times (seconds from the start) of the frames of a video that are kept at fps.
+    '''
+    iio = _imageio()
+    data = _open(source)
+    try:
+        native_fps = iio.immeta(data, plugin='pyav')['fps']
+        n_frames = iio.improps(data, plugin='pyav').shape[0]
+    except Exception as e:
+        logging.error(f"Could not read {_name(source)}: {e}")
+        return np.zeros(0)
+    return sample_offsets(n_frames, native_fps, fps)[1]
+
+
+def _video_frames(source, fps):
+    '''
+    Generator of the frames of a video that are kept at fps.
+    '''
+    iio = _imageio()
+    data = _open(source)
+    native_fps = iio.immeta(data, plugin='pyav')['fps']
+    n_frames = iio.improps(data, plugin='pyav').shape[0]
+    keep = set(sample_offsets(n_frames, native_fps, fps)[0].tolist())
+    for i, frame in enumerate(iio.imiter(data, plugin='pyav')):
+        if i in keep:
+            yield frame
+
+
+def _imageio():
+    try:
+        import imageio.v3 as iio
+    except ImportError:
+        raise ImportError('Decoding videos requires imageio and av. Install them with: pip install imageio av')
+    return iio
+
+
+def _open(source):
+    # Files are read by the decoders from their filename, and elements in shards from their bytes #
+    if isinstance(source, (str, os.PathLike)):
+        return source
+    if source.shard is None:
+        return source.location
+    from .sinks import read_entry
+    return read_entry(source)
+
+
+def _is_video(source):
+    return _name(source).lower().endswith(VIDEO_EXTENSIONS)
+
+
+def _name(source):
+    return str(source) if isinstance(source, (str, os.PathLike)) else source.location
+
+
+def _to_datetime64(timestamps):
+    if isinstance(timestamps, np.ndarray) and np.issubdtype(timestamps.dtype, np.datetime64):
+        return timestamps.astype('datetime64[us]')
+    # Aware datetimes are converted to UTC, naive ones are taken to be UTC already #
+    return np.array([t.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+                     if isinstance(t, datetime.datetime) and t.tzinfo is not None else t for t in timestamps],
+                    dtype='datetime64[us]')
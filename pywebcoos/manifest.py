@@ -0,0 +1,62 @@
+import sqlite3
+import threading
+
+
+# Name of the manifest database kept in a sync directory #
+MANIFEST_NAME = '.pywebcoos_manifest.sqlite'
+
+
+class Manifest():
+
+    def __init__(self, path):
+        '''
+        Class to record the files downloaded into a directory, and the newest element timestamp synced for
+        each service, in a SQLite database. Safe to use from several threads.
+        '''
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS files ('
+                             'url TEXT PRIMARY KEY, service TEXT, filename TEXT, timestamp TEXT, size INTEGER)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS watermarks (service TEXT PRIMARY KEY, timestamp TEXT)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def has(self, url):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM files WHERE url = ?', (url,)).fetchone() is not None
+
+    def add(self, service, url, filename, timestamp, size):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                             (url, service, filename, timestamp, size))
+
+    def files(self, service):
+        '''
+        Function to get the (url, filename, timestamp, size) of the files recorded for a service, in timestamp order.
+        '''
+        with self._lock:
+            return self._db.execute('SELECT url, filename, timestamp, size FROM files WHERE service = ? '
+                                    'ORDER BY timestamp', (service,)).fetchall()
+
+    def get_watermark(self, service):
+        '''
+        Function to get the UTC ISO timestamp of the newest element synced for a service, or None.
+        '''
+        with self._lock:
+            row = self._db.execute('SELECT timestamp FROM watermarks WHERE service = ?', (service,)).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, service, timestamp):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO watermarks VALUES (?, ?)', (service, timestamp))
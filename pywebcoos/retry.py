@@ -0,0 +1,109 @@
+import contextlib
+import datetime
+import email.utils
+import random
+import threading
+import time
+
+
+class RetryPolicy():
+
+    def __init__(self, retries=5, backoff=0.5, max_backoff=60, jitter=True,
+                 statuses=(429, 500, 502, 503, 504)):
+        '''
+        Class to describe how failed requests are retried.
+        
+        args:
+        _ _ _ _ _ _ 
+        retries : int, optional
+            Number of times a request is retried after a retryable status or a connection error. Default is 5.
+        backoff : float, optional
+            Delay in seconds before the first retry. The delay doubles on each further retry. Default is 0.5.
+        max_backoff : float, optional
+            Longest delay in seconds between retries, unless the server asks for longer with Retry-After.
+            Default is 60.
+        jitter : bool, optional
+            Whether to pick a random delay between 0 and the backoff delay, so that clients that failed
+            together do not all retry together. Default is True.
+        statuses : tuple, optional
+            HTTP status codes that are retried. Default is (429, 500, 502, 503, 504).
+        '''
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = tuple(statuses)
+
+    def should_retry(self, status_code):
+        return status_code in self.statuses
+
+    def delay(self, attempt, retry_after=None):
+        '''
+        Function to get the number of seconds to wait before retry number attempt + 1. A Retry-After header
+        value, in seconds or as an HTTP date, is used instead of the backoff if it is given.
+        '''
+        wait = self._parse_retry_after(retry_after)
+        if wait is not None:
+            return wait
+        wait = min(self.max_backoff, self.backoff * 2 ** attempt)
+        if self.jitter:
+            wait = random.uniform(0, wait)
+        return wait
+
+    def _parse_retry_after(self, retry_after):
+        if not retry_after:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            when = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=datetime.timezone.utc)
+        return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class AdaptiveLimiter():
+
+    def __init__(self, maximum=64, minimum=1, cooldown=1.0):
+        '''
+        Class to limit the number of requests in flight. The limit is halved when the server pushes back
+        (at most once per cooldown seconds) and grows by about one for each limit's worth of successful
+        requests, up to maximum.
+        '''
+        self.maximum = maximum
+        self.minimum = minimum
+        self.cooldown = cooldown
+        self.limit = float(maximum)
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def slot(self):
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def succeeded(self):
+        with self._condition:
+            if self.limit < self.maximum:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self._condition.notify_all()
+
+    def throttled(self):
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease >= self.cooldown:
+                self.limit = max(self.minimum, self.limit / 2)
+                self._last_decrease = now
@@ -0,0 +1,304 @@
+"""
+Temporal sampling of element listings.
+
+A sampler picks which elements to download from their times, in one vectorized pass over each page of an
+ElementTable. Pass one as the interval argument of API.download (and the other listing methods):
+
+    Every('15s')                           the first frame in each 15 second bin
+    Every('2h', max_per_bin=3)             the first 3 frames in each 2 hour bin
+    Every('1h', offset='30min')            the first frame in each hour long bin starting at half past
+    Nearest('10min', tolerance='1min')     the frame nearest each 10 minute mark, if one is within a minute
+
+Grids are aligned to midnight UTC (shifted by offset). An int interval keeps its original meaning, the
+frames whose minute is a multiple of it (MinuteInterval), and a period string or timedelta is read as Every.
+"""
+
+import datetime
+import re
+
+import numpy as np
+
+from .elements import ElementTable
+
+
+_UNITS = {'us': 1, 'ms': 1000, 's': 1000000, 'sec': 1000000, 'min': 60000000, 'm': 60000000,
+          'h': 3600000000, 'hr': 3600000000, 'd': 86400000000, 'day': 86400000000}
+
+
+class Sampler():
+    '''
+    Base class of the samplers. Subclasses implement stream(), which returns an object whose feed(table)
+    method takes successive time-ordered pages of elements and returns the selected elements that are
+    final so far, and whose flush() method returns the rest once there are no more pages.
+    '''
+
+    def stream(self):
+        raise NotImplementedError
+
+    def grid(self):
+        '''
+        Function to get the (period, origin) in microseconds of the cells the sampler chooses within, or None
+        if it judges each element on its own. A listing split at cell edges samples the same as one listing.
+        '''
+        return None
+
+    def expected(self, count, seconds):
+        '''
+        Function to estimate how many of count elements spread over seconds are selected.
+        '''
+        raise NotImplementedError
+
+    def spec(self):
+        '''
+        Function to get a json-serializable description of the sampler, see from_spec.
+        '''
+        raise NotImplementedError
+
+    def select(self, table):
+        '''
+        Function to sample a whole ElementTable at once. Returns the selected elements, sorted by time.
+        '''
+        stream = self.stream()
+        return ElementTable.concat([stream.feed(table), stream.flush()])
+
+
+class MinuteInterval(Sampler):
+
+    def __init__(self, interval_minutes):
+        '''
+        Class to keep the elements whose minute is a multiple of interval_minutes, as the int interval
+        argument always has.
+        '''
+        if isinstance(interval_minutes, bool) or not isinstance(interval_minutes, (int, np.integer)) or interval_minutes < 1:
+            raise ValueError('Requested interval must be a positive whole number of minutes or a sampler.')
+        self.interval_minutes = int(interval_minutes)
+
+    def __repr__(self):
+        return f"MinuteInterval({self.interval_minutes})"
+
+    def stream(self):
+        return _MaskStream(lambda table: table.interval_mask(self.interval_minutes))
+
+    def expected(self, count, seconds):
+        return count * len(range(0, 60, self.interval_minutes)) / 60
+
+    def spec(self):
+        return {'sampler': 'MinuteInterval', 'interval_minutes': self.interval_minutes}
+
+
+class Every(Sampler):
+
+    def __init__(self, period, offset=0, max_per_bin=1):
+        '''
+        Class to split time into bins of length period and keep the first max_per_bin elements of each.
+
+        args:
+        _ _ _ _ _ _
+        period : str, float or datetime.timedelta
+            Length of the bins, e.g. '15s', '10min', '2h', '1d', a number of seconds or a timedelta.
+        offset : str, float or datetime.timedelta, optional
+            Shift of the bins from midnight UTC. Default is 0.
+        max_per_bin : int, optional
+            Most elements kept per bin. Default is 1.
+        '''
+        self.period = to_microseconds(period)
+        self.offset = to_microseconds(offset)
+        if self.period <= 0:
+            raise ValueError('Sampling period must be positive.')
+        if max_per_bin < 1:
+            raise ValueError('max_per_bin must be at least 1.')
+        self.max_per_bin = int(max_per_bin)
+
+    def __repr__(self):
+        return f"Every({_timedelta(self.period)}, offset={_timedelta(self.offset)}, max_per_bin={self.max_per_bin})"
+
+    def stream(self):
+        return _BinStream(self)
+
+    def grid(self):
+        return self.period, self.offset
+
+    def expected(self, count, seconds):
+        return min(count, seconds * 1000000 / self.period * self.max_per_bin)
+
+    def spec(self):
+        return {'sampler': 'Every', 'period': self.period, 'offset': self.offset, 'max_per_bin': self.max_per_bin}
+
+
+class Nearest(Sampler):
+
+    def __init__(self, period, offset=0, tolerance=None):
+        '''
+        Class to keep, for each mark of a grid with spacing period, the element nearest to it.
+
+        args:
+        _ _ _ _ _ _
+        period : str, float or datetime.timedelta
+            Spacing of the grid marks, e.g. '10min'.
+        offset : str, float or datetime.timedelta, optional
+            Shift of the marks from midnight UTC. Default is 0.
+        tolerance : str, float or datetime.timedelta, optional
+            Furthest an element can be from a mark to be kept. Default is None (half the period, so every
+            mark with an element either side of it gets one).
+        '''
+        self.period = to_microseconds(period)
+        self.offset = to_microseconds(offset)
+        if self.period <= 0:
+            raise ValueError('Sampling period must be positive.')
+        self.tolerance = self.period // 2 if tolerance is None else to_microseconds(tolerance)
+
+    def __repr__(self):
+        return f"Nearest({_timedelta(self.period)}, offset={_timedelta(self.offset)}, tolerance={_timedelta(self.tolerance)})"
+
+    def stream(self):
+        return _HoldBackStream(self._marks, self._mask)
+
+    def grid(self):
+        # Each mark's cell runs from half a period before it to half a period after #
+        return self.period, self.offset - self.period // 2
+
+    def expected(self, count, seconds):
+        return min(count, seconds * 1000000 / self.period)
+
+    def spec(self):
+        return {'sampler': 'Nearest', 'period': self.period, 'offset': self.offset, 'tolerance': self.tolerance}
+
+    def _marks(self, times):
+        # Index of the grid mark nearest each time (ties go to the later mark) #
+        return np.floor_divide(times - self.offset + self.period // 2, self.period)
+
+    def _mask(self, times):
+        marks = self._marks(times)
+        distance = np.abs(times - self.offset - marks * self.period)
+        # Sort by mark then distance, and take the first element of each mark #
+        order = np.lexsort((distance, marks))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = marks[order][1:] != marks[order][:-1]
+        mask = np.zeros(len(times), dtype=bool)
+        mask[order[first]] = True
+        return mask & (distance <= self.tolerance)
+
+
+def as_sampler(interval):
+    '''
+    Function to get the sampler for an interval argument: a Sampler is used as is, an int is a
+    MinuteInterval and a period string or timedelta is Every(period).
+    '''
+    if isinstance(interval, Sampler):
+        return interval
+    if isinstance(interval, (str, datetime.timedelta)):
+        return Every(interval)
+    return MinuteInterval(interval)
+
+
+def from_spec(spec):
+    '''
+    Function to rebuild a sampler from its spec().
+    '''
+    spec = dict(spec)
+    name = spec.pop('sampler')
+    if name == 'MinuteInterval':
+        return MinuteInterval(spec['interval_minutes'])
+    # Periods in a spec are in microseconds #
+    times = {key: datetime.timedelta(microseconds=spec.pop(key)) for key in ['period', 'offset', 'tolerance'] if key in spec}
+    if name == 'Every':
+        return Every(**times, **spec)
+    if name == 'Nearest':
+        return Nearest(**times, **spec)
+    raise ValueError(f"Unknown sampler '{name}'.")
+
+
+def to_microseconds(value):
+    '''
+    Function to convert a period ('15s', '10min', '2h', '1d', '500ms'), a number of seconds or a timedelta
+    to whole microseconds.
+    '''
+    if isinstance(value, datetime.timedelta):
+        return value // datetime.timedelta(microseconds=1)
+    if isinstance(value, str):
+        match = re.fullmatch(r'\s*([0-9]*\.?[0-9]+)\s*([a-z]+)\s*', value.lower())
+        if match is None or match.group(2) not in _UNITS:
+            raise ValueError(f"Could not read the period '{value}'. Use e.g. '15s', '10min', '2h' or '1d'.")
+        return int(round(float(match.group(1)) * _UNITS[match.group(2)]))
+    return int(round(value * 1000000))
+
+
+def _timedelta(microseconds):
+    return datetime.timedelta(microseconds=int(microseconds))
+
+
+def _microseconds(table):
+    return table.times.astype('datetime64[us]').astype(np.int64)
+
+
+class _MaskStream():
+    '''
+    Stream of a sampler that judges each element on its own.
+    '''
+
+    def __init__(self, mask):
+        self._mask = mask
+
+    def feed(self, table):
+        return table[self._mask(table)]
+
+    def flush(self):
+        return ElementTable.empty()
+
+
+class _BinStream():
+    '''
+    Stream of Every. The number of elements kept in the latest bin is carried to the next page, so
+    elements are final as soon as they are seen.
+    '''
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self._last_bin = None
+        self._n_in_last_bin = 0
+
+    def feed(self, table):
+        table = table.sort()
+        if not len(table):
+            return table
+        bins = np.floor_divide(_microseconds(table) - self.sampler.offset, self.sampler.period)
+        # Rank of each element within its bin #
+        new_bin = np.ones(len(bins), dtype=bool)
+        new_bin[1:] = bins[1:] != bins[:-1]
+        starts = np.flatnonzero(new_bin)
+        rank = np.arange(len(bins)) - starts[np.cumsum(new_bin) - 1]
+        if bins[0] == self._last_bin:
+            rank[bins == self._last_bin] += self._n_in_last_bin
+        self._last_bin = bins[-1]
+        self._n_in_last_bin = int(rank[-1]) + 1
+        return table[rank < self.sampler.max_per_bin]
+
+    def flush(self):
+        return ElementTable.empty()
+
+
+class _HoldBackStream():
+    '''
+    Stream of a sampler that needs all the elements of a group to choose between them. The elements of
+    the latest group on each page are held back until a later page (or flush) shows the group is complete.
+    '''
+
+    def __init__(self, groups, mask):
+        self._groups = groups
+        self._mask = mask
+        self._held = ElementTable.empty()
+
+    def feed(self, table):
+        table = ElementTable.concat([self._held, table]).sort()
+        if not len(table):
+            return table
+        times = _microseconds(table)
+        groups = self._groups(times)
+        last = groups == groups[-1]
+        self._held = table[last]
+        return table[self._mask(times) & ~last]
+
+    def flush(self):
+        table = self._held
+        self._held = ElementTable.empty()
+        return table[self._mask(_microseconds(table))]
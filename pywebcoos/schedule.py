@@ -0,0 +1,186 @@
+"""
+Sets of local time windows (e.g. the same times of day over many days), and planning of the queries that
+list them together.
+"""
+
+import datetime
+
+import numpy as np
+
+
+class Daily():
+
+    def __init__(self, start_time, stop_time, first_day, last_day, weekdays=None):
+        '''
+        Class for the same local time window on every day of a date range, e.g. 10:00 to 10:10 every day
+        of 2024. Pass it as the start argument of API.download (and the other listing methods) with stop=None.
+
+        args:
+        _ _ _ _ _ _
+        start_time : str
+            Local start time of the window each day, as HHMM.
+        stop_time : str
+            Local stop time of the window each day, as HHMM. If it is before start_time the window ends
+            on the next day.
+        first_day : str or int
+            First day, as yyyymmdd.
+        last_day : str or int
+            Last day (inclusive), as yyyymmdd.
+        weekdays : list, optional
+            Days of the week to include, 0 for Monday to 6 for Sunday. Default is None (every day).
+
+        Example usage:
+        _ _ _ _ _ _
+        fnames = api.download('Charleston Harbor, SC', 'one-minute-stills', Daily('1000', '1010', 20240101, 20241231), None, 1, '.')
+        '''
+        self.start_time = _parse_time(str(start_time), 'start')
+        self.stop_time = _parse_time(str(stop_time), 'stop')
+        self.first_day = _parse_day(str(first_day), 'first')
+        self.last_day = _parse_day(str(last_day), 'last')
+        if self.last_day < self.first_day:
+            raise ValueError('Requested last day is before the first day.')
+        self.weekdays = None if weekdays is None else sorted(set(int(d) for d in weekdays))
+        if self.weekdays is not None and not all(0 <= d <= 6 for d in self.weekdays):
+            raise ValueError('Weekdays must be between 0 (Monday) and 6 (Sunday).')
+
+    def __repr__(self):
+        return f"Daily({self.start_time}-{self.stop_time}, {self.first_day} to {self.last_day})"
+
+    def local_windows(self):
+        '''
+        Function to get the local (start, stop) times of the windows, as two datetime64[m] arrays.
+        '''
+        days = np.arange(np.datetime64(self.first_day, 'D'), np.datetime64(self.last_day, 'D') + 1)
+        if self.weekdays is not None:
+            # 1970-01-01 was a Thursday (weekday 3) #
+            weekday = (days.astype(np.int64) + 3) % 7
+            days = days[np.isin(weekday, self.weekdays)]
+        start = np.timedelta64(self.start_time.hour * 60 + self.start_time.minute, 'm')
+        stop = np.timedelta64(self.stop_time.hour * 60 + self.stop_time.minute, 'm')
+        if stop < start:
+            stop += np.timedelta64(1, 'D')
+        days = days.astype('datetime64[m]')
+        return days + start, days + stop
+
+
+class Windows():
+
+    def __init__(self, windows):
+        '''
+        Class for a list of (start, stop) local time windows, given as yyyymmddHHMM.
+        '''
+        self.windows = [(str(w0), str(w1)) for w0, w1 in windows]
+
+    def __repr__(self):
+        return f"Windows({len(self.windows)} windows)"
+
+    def local_windows(self):
+        '''
+        Function to get the local (start, stop) times of the windows, as two datetime64[m] arrays.
+        '''
+        return (np.array([_to_iso_minute(w0) for w0, w1 in self.windows], dtype='datetime64[m]'),
+                np.array([_to_iso_minute(w1) for w0, w1 in self.windows], dtype='datetime64[m]'))
+
+
+def union_windows(starts, stops):
+    '''
+    Function to sort windows, given as datetime64 arrays of their starts and stops, and join the ones that
+    overlap. Returns the starts and stops of the joined windows.
+    '''
+    order = np.argsort(starts, kind='stable')
+    starts, stops = starts[order], stops[order]
+    if not len(starts):
+        return starts, stops
+    reach = np.maximum.accumulate(stops)
+    # A window starts a new group unless it begins before an earlier window ends #
+    new = np.ones(len(starts), dtype=bool)
+    new[1:] = starts[1:] > reach[:-1]
+    # The stop of each group is the furthest reach before the next group starts #
+    last = np.append(np.flatnonzero(new)[1:] - 1, len(starts) - 1)
+    return starts[new], reach[last]
+
+
+def plan_queries(inventory, starts, stops, page_size):
+    '''
+    Function to plan the /elements/ queries that list a set of sorted, non-overlapping UTC windows.
+    Windows that the inventory shows to have no data are skipped (unless they reach the latest bin, which
+    may have had data added since). Each window is added to the query before it, gap and all, when the
+    inventory's counts show that this adds fewer pages of page_size elements than listing the window in
+    a query of its own would take. Returns a list of (start, end) ISO windows.
+    '''
+    bins = sorted((to_datetime64(row['Bin Start']), to_datetime64(row['Bin End']), row['Count'] or 0)
+                  for row in inventory if row['Bin Start'] is not None and row['Bin End'] is not None)
+    sizes = gaps = None
+    if bins:
+        bin_starts = np.array([b[0] for b in bins])
+        bin_ends = np.array([b[1] for b in bins])
+        counts = np.array([b[2] for b in bins], dtype=float)
+        cumulative = np.concatenate([[0.0], np.cumsum(counts)])
+
+        def expected(t):
+            # Elements before each time, taking them to be spread evenly through each bin #
+            i = np.searchsorted(bin_starts, t, side='right') - 1
+            j = np.clip(i, 0, None)
+            span = (bin_ends[j] - bin_starts[j]).astype(np.int64)
+            fraction = np.clip((t - bin_starts[j]).astype(np.int64) / np.maximum(span, 1), 0, 1)
+            return np.where(i < 0, 0.0, cumulative[j] + counts[j] * fraction)
+
+        has_data = (expected(stops) - expected(starts) > 0) | (stops >= bin_starts[-1])
+        starts, stops = starts[has_data], stops[has_data]
+        sizes = expected(stops) - expected(starts)
+        gaps = expected(starts[1:]) - expected(stops[:-1])
+
+    def pages(n_elements):
+        return max(1, int(np.ceil(n_elements / page_size)))
+
+    queries = []
+    n_query = 0  # Elements expected in the latest query #
+    for i in range(len(starts)):
+        if i > 0 and sizes is not None:
+            merged = n_query + gaps[i - 1] + sizes[i]
+            if pages(merged) - pages(n_query) < pages(sizes[i]):
+                queries[-1][1] = stops[i]
+                n_query = merged
+                continue
+        queries.append([starts[i], stops[i]])
+        n_query = sizes[i] if sizes is not None else 0
+    return [(to_iso(w0), to_iso(w1)) for w0, w1 in queries]
+
+
+def to_datetime64(iso):
+    '''
+    Function to convert an ISO time to a naive UTC datetime64[us].
+    '''
+    dt = datetime.datetime.fromisoformat(iso.replace('Z', '+00:00'))
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return np.datetime64(dt, 'us')
+
+
+def to_iso(t):
+    '''
+    Function to convert a naive UTC datetime64 to an ISO time.
+    '''
+    return str(np.datetime_as_string(t, unit='s')) + '+00:00'
+
+
+def _to_iso_minute(date):
+    return f"{date[0:4]}-{date[4:6]}-{date[6:8]}T{date[8:10]}:{date[10:12]}"
+
+
+def _parse_time(time, name):
+    try:
+        if len(time) != 4:
+            raise ValueError
+        return datetime.time(int(time[0:2]), int(time[2:4]))
+    except ValueError:
+        raise ValueError('Requested '+name+' time is of improper format. Format should be HHMM.')
+
+
+def _parse_day(day, name):
+    try:
+        if len(day) != 8:
+            raise ValueError
+        return datetime.date(int(day[0:4]), int(day[4:6]), int(day[6:8]))
+    except ValueError:
+        raise ValueError('Requested '+name+' day is of improper format. Format should be yyyymmdd.')
@@ -0,0 +1,176 @@
+"""
+Deterministic splitting of one download job into work units and shards, so that several machines can each
+run a part of it with no overlaps or gaps between them.
+"""
+
+import collections
+import datetime
+import heapq
+import json
+
+
+# A part of a job: the UTC window [start, stop) (the job's last unit includes its stop), the estimated
+# number of files and bytes in it, and the shard it is assigned to #
+WorkUnit = collections.namedtuple('WorkUnit', ['index', 'start', 'stop', 'files', 'bytes', 'shard'])
+
+
+class DownloadPlan():
+
+    def __init__(self, camera_name, product_name, interval, units, n_shards):
+        '''
+        Class to hold a download job split into work units that are assigned to n_shards shards. Build one
+        with API.plan_download, save it with save() and run each shard with API.download_shard, e.g. on a
+        different machine. The plan is fixed once made, so every machine sees the same units.
+
+        attributes:
+        _ _ _ _ _ _
+        camera_name, product_name : str
+            The camera and product of the job.
+        interval : dict
+            The spec() of the job's sampler (see sampling.from_spec).
+        units : list
+            WorkUnit tuples, in time order.
+        n_shards : int
+            Number of shards the units are assigned to.
+        '''
+        self.camera_name = camera_name
+        self.product_name = product_name
+        self.interval = interval
+        self.units = [WorkUnit(*unit) for unit in units]
+        self.n_shards = n_shards
+
+    def __repr__(self):
+        return (f"DownloadPlan({self.camera_name}, {self.product_name}: {len(self.units)} units in {self.n_shards} "
+                f"shards, about {self.total_files:.0f} files and {self.total_bytes / 1e6:.1f} MB)")
+
+    @property
+    def total_files(self):
+        '''
+        Estimated number of files in the job.
+        '''
+        return sum(unit.files for unit in self.units)
+
+    @property
+    def total_bytes(self):
+        '''
+        Estimated number of bytes in the job.
+        '''
+        return sum(unit.bytes for unit in self.units)
+
+    def shard(self, i):
+        '''
+        Function to get the work units of shard i (0 to n_shards - 1), in time order.
+        '''
+        if not 0 <= i < self.n_shards:
+            raise ValueError(f"Shard must be between 0 and {self.n_shards - 1}.")
+        return [unit for unit in self.units if unit.shard == i]
+
+    def shard_bytes(self):
+        '''
+        Function to get the estimated bytes of each shard.
+        '''
+        totals = [0.0] * self.n_shards
+        for unit in self.units:
+            totals[unit.shard] += unit.bytes
+        return totals
+
+    def to_dict(self):
+        return {'camera_name': self.camera_name, 'product_name': self.product_name, 'interval': self.interval,
+                'n_shards': self.n_shards, 'units': [list(unit) for unit in self.units]}
+
+    @classmethod
+    def from_dict(cls, plan):
+        return cls(plan['camera_name'], plan['product_name'], plan['interval'], plan['units'], plan['n_shards'])
+
+    def save(self, path):
+        '''
+        Function to write the plan to a json file.
+        '''
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Function to read a plan written by save().
+        '''
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+def plan_units(inventory, start, stop, n_units, sampler):
+    '''
+    Function to split the UTC window [start, stop] into at most n_units windows of about equal estimated
+    bytes, using the inventory bins. Cuts are made at bin edges, moved back to the edge of the sampler's
+    cells if it has any. Returns a list of (start, stop, files, bytes) with ISO times.
+    '''
+    bins = []
+    for row in inventory:
+        if row['Bin Start'] is None or row['Bin End'] is None:
+            continue
+        bin_start, bin_end = _parse_iso(row['Bin Start']), _parse_iso(row['Bin End'])
+        if bin_end <= start or bin_start >= stop or bin_end <= bin_start:
+            continue
+        # Bins cut by the window count in proportion to how much of them is in it #
+        clipped_start, clipped_end = max(bin_start, start), min(bin_end, stop)
+        fraction = (clipped_end - clipped_start) / (bin_end - bin_start)
+        count = (row['Count'] or 0) * fraction
+        files = sampler.expected(count, (clipped_end - clipped_start).total_seconds()) if count else 0
+        n_bytes = (row['Bytes'] or 0) * fraction * files / count if count else 0
+        bins.append((clipped_start, clipped_end, files, n_bytes))
+    bins.sort()
+
+    total_bytes = sum(b[3] for b in bins)
+    total_files = sum(b[2] for b in bins)
+    # Balance by files if the inventory has no sizes #
+    by_bytes = total_bytes > 0
+    target = (total_bytes if by_bytes else total_files) / max(n_units, 1)
+    units = []
+    unit_start = start
+    files = n_bytes = 0
+    for bin_start, bin_end, bin_files, bin_bytes in bins:
+        files += bin_files
+        n_bytes += bin_bytes
+        if target > 0 and (n_bytes if by_bytes else files) >= target and len(units) < n_units - 1:
+            cut = _align(bin_end, sampler)
+            if unit_start < cut < stop:
+                # Elements of the bin after an aligned cut are counted in the next unit #
+                after = (bin_end - cut) / (bin_end - bin_start) if cut < bin_end else 0
+                units.append((unit_start, cut, files - bin_files * after, n_bytes - bin_bytes * after))
+                unit_start = cut
+                files, n_bytes = bin_files * after, bin_bytes * after
+    units.append((unit_start, stop, files, n_bytes))
+    return [(u0.isoformat(), u1.isoformat(), round(f, 1), round(b)) for u0, u1, f, b in units]
+
+
+def assign_shards(units, n_shards):
+    '''
+    Function to assign work units to shards, each unit (largest first) to the shard with the fewest bytes
+    so far, or the fewest files if the units have no sizes (as plan_units balances them). Ties go to the
+    lower index, so the assignment only depends on the units.
+    '''
+    measure = 3 if any(unit[3] for unit in units) else 2
+    loads = [(0, i) for i in range(n_shards)]
+    shards = [None] * len(units)
+    for i in sorted(range(len(units)), key=lambda i: (-units[i][measure], i)):
+        load, shard = heapq.heappop(loads)
+        shards[i] = shard
+        heapq.heappush(loads, (load + units[i][measure], shard))
+    return [WorkUnit(i, *unit, shards[i]) for i, unit in enumerate(units)]
+
+
+def _align(t, sampler):
+    grid = sampler.grid()
+    if grid is None:
+        return t
+    period, origin = grid
+    epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+    microseconds = (t - epoch) // datetime.timedelta(microseconds=1)
+    return t - datetime.timedelta(microseconds=(microseconds - origin) % period)
+
+
+def _parse_iso(iso):
+    dt = datetime.datetime.fromisoformat(iso.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt
@@ -0,0 +1,420 @@
+"""
+Output sinks for downloads. Pass a sink as the save_dir argument of API.download (or download_shard and
+download_many) to choose how the files are stored:
+
+    DirectorySink('out')                  one file per element in one directory, as with a plain save_dir
+    PartitionedSink('out')                one file per element under out/camera/product/YYYY/MM/DD
+    TarSink('out', max_shard_bytes=1e9)   elements packed into tar shards of about 1 GB each
+    ZipSink('out', max_shard_bytes=1e9)   elements packed into (uncompressed) zip shards
+
+Every sink records its elements in a SQLite index in its root directory, so checking whether an element
+is stored already, listing a time range and reading the frame nearest a timestamp don't need to look at
+the files themselves. Sinks can be appended to by later downloads.
+"""
+
+import collections
+import datetime
+import io
+import logging
+import os
+import re
+import sqlite3
+import struct
+import tarfile
+import threading
+import zipfile
+
+
+# Name of the index database kept in the root directory of a sink #
+INDEX_NAME = '.pywebcoos_index.sqlite'
+# Number of elements added between commits of the index #
+COMMIT_EVERY = 1000
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# One stored element. location is the path of its file, or of its member inside a shard, shard is the path
+# of the shard holding it (None for one file per element) and offset locates it in the shard (see read_entry) #
+Entry = collections.namedtuple('Entry', ['timestamp', 'url', 'location', 'size', 'shard', 'offset'])
+
+
+class Sink():
+    '''
+    Base class of the sinks. A sink stores the bytes of elements, either as files it gives the path of
+    (path() returns the filename, and the file is written by the caller and then recorded with add()) or
+    packed into shards (sharded is True, and write() stores the bytes).
+    '''
+
+    sharded = False
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(os.path.join(root, INDEX_NAME), check_same_thread=False)
+        self._n_uncommitted = 0
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS elements (url TEXT PRIMARY KEY, camera TEXT, product TEXT, '
+                             'timestamp INTEGER, location TEXT, shard TEXT, offset INTEGER, size INTEGER)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS elements_time ON elements (camera, product, timestamp)')
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.root!r})"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM elements').fetchone()[0]
+
+    def path(self, camera_name, product_name, element):
+        '''
+        Function to get the filename an element is written to, or None if the sink packs elements into shards.
+        '''
+        return None
+
+    def write(self, camera_name, product_name, element, data):
+        '''
+        Function to store the bytes of an element. Returns its location.
+        '''
+        filename = self.path(camera_name, product_name, element)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename + '.part', 'wb') as f:
+            f.write(data)
+        os.replace(filename + '.part', filename)
+        return self.add(camera_name, product_name, element, filename, len(data))
+
+    def add(self, camera_name, product_name, element, location, size, shard=None, offset=None):
+        '''
+        Function to record a stored element in the index. Returns its location.
+        '''
+        relative = os.path.relpath(location, self.root)
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO elements VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (element.url, camera_name, product_name, _to_microseconds(element.timestamp), relative,
+                              shard, offset, size))
+            self._n_uncommitted += 1
+            if self._n_uncommitted >= COMMIT_EVERY:
+                self._commit()
+        return location
+
+    def location(self, element):
+        '''
+        Function to get the location of a stored element, or None if it is not stored.
+        '''
+        with self._lock:
+            row = self._db.execute('SELECT location FROM elements WHERE url = ?', (element.url,)).fetchone()
+        return None if row is None else os.path.join(self.root, row[0])
+
+    def find(self, camera_name, product_name, start=None, stop=None):
+        '''
+        Function to get the Entry of each stored element of a camera and product from start to stop
+        (inclusive, UTC datetimes or ISO times, None for no bound), in time order.
+        '''
+        query = 'SELECT * FROM elements WHERE camera = ? AND product = ?'
+        args = [camera_name, product_name]
+        if start is not None:
+            query += ' AND timestamp >= ?'
+            args.append(_to_microseconds(start))
+        if stop is not None:
+            query += ' AND timestamp <= ?'
+            args.append(_to_microseconds(stop))
+        with self._lock:
+            rows = self._db.execute(query + ' ORDER BY timestamp', args).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def nearest(self, camera_name, product_name, timestamp):
+        '''
+        Function to get the Entry of the stored element of a camera and product nearest to timestamp (a UTC
+        datetime or ISO time), or None if none are stored.
+        '''
+        t = _to_microseconds(timestamp)
+        query = ('SELECT * FROM elements WHERE camera = ? AND product = ? AND timestamp {} ? '
+                 'ORDER BY timestamp {} LIMIT 1')
+        with self._lock:
+            rows = [self._db.execute(query.format('<=', 'DESC'), (camera_name, product_name, t)).fetchone(),
+                    self._db.execute(query.format('>=', 'ASC'), (camera_name, product_name, t)).fetchone()]
+        rows = [row for row in rows if row is not None]
+        if not rows:
+            return None
+        return self._entry(min(rows, key=lambda row: abs(row[3] - t)))
+
+    def read(self, entry):
+        '''
+        Function to read the bytes of a stored element, given its Entry (see find and nearest).
+        '''
+        return read_entry(entry)
+
+    def flush(self):
+        '''
+        Function to make everything stored so far readable, and commit the index.
+        '''
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._db.close()
+
+    def _commit(self):
+        self._db.commit()
+        self._n_uncommitted = 0
+
+    def _entry(self, row):
+        url, camera, product, timestamp, location, shard, offset, size = row
+        return Entry(_EPOCH + datetime.timedelta(microseconds=timestamp), url, os.path.join(self.root, location), size,
+                     None if shard is None else os.path.join(self.root, shard), offset)
+
+
+class DirectorySink(Sink):
+
+    def __init__(self, root):
+        '''
+        Class to store each element as a file in root, with the same names as a plain save_dir. Files
+        already in root when it is first used as a sink are recorded in the index as they are requested again.
+        '''
+        super().__init__(root)
+
+    def path(self, camera_name, product_name, element):
+        return os.path.join(self.root, _file_name(element.url))
+
+
+class PartitionedSink(Sink):
+
+    def __init__(self, root):
+        '''
+        Class to store each element as a file under root/camera/product/YYYY/MM/DD (by the element's UTC
+        date), so no directory grows beyond a day of files.
+        '''
+        super().__init__(root)
+
+    def path(self, camera_name, product_name, element):
+        return os.path.join(self.root, _safe_name(camera_name), _safe_name(product_name),
+                            element.timestamp.strftime('%Y'), element.timestamp.strftime('%m'),
+                            element.timestamp.strftime('%d'), _file_name(element.url))
+
+
+class _ShardSink(Sink):
+    '''
+    Base class of the sinks that pack elements into numbered shards in root. Elements are appended to the
+    latest shard until it reaches max_shard_bytes, then a new one is started. Each element's offset in its
+    shard is kept in the index, so it is read back with one seek, without opening the archive. The shard
+    is flushed to disk before each commit of the index, and index rows pointing past the end of the data
+    that survived in the latest shard (e.g. after a crash) are dropped when the sink is opened.
+    '''
+
+    EXTENSION = None
+    sharded = True
+
+    def __init__(self, root, max_shard_bytes=1024 ** 3):
+        super().__init__(root)
+        self.max_shard_bytes = int(max_shard_bytes)
+        self._archive = None
+        self._shard = None
+        self._shard_bytes = 0
+        shards = self.shards()
+        if shards:
+            self._recover(shards[-1])
+
+    def write(self, camera_name, product_name, element, data):
+        name = _file_name(element.url)
+        with self._lock:
+            if self._archive is None or (self._shard_bytes and self._shard_bytes + len(data) > self.max_shard_bytes):
+                self._next_shard()
+            offset = self._append(name, element, data)
+            self._shard_bytes = self._archive_size()
+            return self.add(camera_name, product_name, element, os.path.join(self.root, self._shard, name), len(data),
+                            self._shard, offset)
+
+    def read(self, entry):
+        with self._lock:
+            if self._archive is not None and entry.shard == os.path.join(self.root, self._shard):
+                self._flush_archive()
+        return read_entry(entry)
+
+    def close(self):
+        with self._lock:
+            if self._archive is not None:
+                self._archive.close()
+                self._archive = None
+        super().close()
+
+    def _commit(self):
+        # The rows must not point at data that could still be lost #
+        if self._archive is not None:
+            self._flush_archive(sync=True)
+        super()._commit()
+
+    def _recover(self, path):
+        '''
+        Function to drop the index rows of a shard whose data runs past the end of what survived in it,
+        repairing the shard so it can be appended to where the format allows.
+        '''
+        end = self._repair(path)
+        with self._lock, self._db:
+            n_lost = self._db.execute('DELETE FROM elements WHERE shard = ? AND offset + size > ?',
+                                      (os.path.basename(path), end)).rowcount
+        if n_lost:
+            logging.warning(f"{n_lost} elements indexed in {path} did not reach the disk and will be fetched again")
+
+    def shards(self):
+        '''
+        Function to get the paths of the shards, in order.
+        '''
+        return [os.path.join(self.root, name) for name in sorted(os.listdir(self.root)) if self._is_shard(name)]
+
+    def _is_shard(self, name):
+        return re.fullmatch(r'shard-\d{6}\.' + self.EXTENSION, name) is not None
+
+    def _next_shard(self):
+        '''
+        Function to open the shard to append to: the latest one if it has room (when the sink is first
+        used), otherwise a new one.
+        '''
+        names = [os.path.basename(shard) for shard in self.shards()]
+        if self._archive is None and names:
+            path = os.path.join(self.root, names[-1])
+            if os.path.getsize(path) < self.max_shard_bytes:
+                try:
+                    self._archive = self._open(path, append=True)
+                    self._shard = names[-1]
+                    self._shard_bytes = self._archive_size()
+                    return
+                except (tarfile.TarError, zipfile.BadZipFile, EOFError) as e:
+                    logging.warning(f"Could not append to {path} ({e}), starting a new shard")
+        if self._archive is not None:
+            self._archive.close()
+        number = int(names[-1][6:12]) + 1 if names else 0
+        self._shard = f"shard-{number:06d}.{self.EXTENSION}"
+        self._archive = self._open(os.path.join(self.root, self._shard), append=False)
+        self._shard_bytes = 0
+        logging.info(f"Writing to shard {self._shard}")
+
+
+class TarSink(_ShardSink):
+    '''
+    Class to pack elements into uncompressed tar shards of about max_shard_bytes each in root, named
+    shard-000000.tar, shard-000001.tar, ... The shards are ordinary tar files, e.g. for tar -x.
+    '''
+
+    EXTENSION = 'tar'
+
+    def _open(self, path, append):
+        return tarfile.open(path, 'a' if append else 'w', format=tarfile.PAX_FORMAT)
+
+    def _append(self, name, element, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(element.timestamp.timestamp())
+        self._archive.addfile(info, io.BytesIO(data))
+        # The data ends the member, padded to a whole block #
+        return self._archive.offset - tarfile.BLOCKSIZE * -(-len(data) // tarfile.BLOCKSIZE)
+
+    def _archive_size(self):
+        return self._archive.offset
+
+    def _flush_archive(self, sync=False):
+        self._archive.fileobj.flush()
+        if sync:
+            os.fsync(self._archive.fileobj.fileno())
+
+    def _repair(self, path):
+        '''
+        Function to cut a shard back to the end of its last complete member, ending it with the end of
+        archive blocks if they are missing. Returns the end of the last complete member.
+        '''
+        size = os.path.getsize(path)
+        end = 0
+        try:
+            with tarfile.open(path, 'r') as archive:
+                for member in archive:
+                    if member.offset_data + member.size > size:
+                        break
+                    end = member.offset_data + tarfile.BLOCKSIZE * -(-member.size // tarfile.BLOCKSIZE)
+        except (tarfile.TarError, EOFError):
+            pass
+        with open(path, 'r+b') as f:
+            f.seek(end)
+            tail = f.read()
+            if len(tail) < 2 * tarfile.BLOCKSIZE or tail.strip(b'\0'):
+                # Whatever follows the last complete member is replaced with zeros (the end of the archive) #
+                f.truncate(end)
+                f.truncate(end + 2 * tarfile.BLOCKSIZE)
+        return end
+
+
+class ZipSink(_ShardSink):
+    '''
+    Class to pack elements into zip shards of about max_shard_bytes each in root, named shard-000000.zip,
+    shard-000001.zip, ... Files are stored without compression, since images are compressed already. A
+    shard's central directory is written when the sink is closed.
+    '''
+
+    EXTENSION = 'zip'
+
+    def _open(self, path, append):
+        return zipfile.ZipFile(path, 'a' if append else 'w', compression=zipfile.ZIP_STORED)
+
+    def _append(self, name, element, data):
+        info = zipfile.ZipInfo(name, element.timestamp.timetuple()[:6])
+        self._archive.writestr(info, bytes(data))
+        return info.header_offset
+
+    def _archive_size(self):
+        return self._archive.fp.tell()
+
+    def _flush_archive(self, sync=False):
+        self._archive.fp.flush()
+        if sync:
+            os.fsync(self._archive.fp.fileno())
+
+    def _repair(self, path):
+        '''
+        Function to get where the complete data of a shard ends: the start of its central directory, or the
+        end of the file if it has none (then a new shard is started rather than appending to it).
+        '''
+        try:
+            with zipfile.ZipFile(path) as archive:
+                return archive.start_dir
+        except (zipfile.BadZipFile, EOFError):
+            return os.path.getsize(path)
+
+
+def read_entry(entry):
+    '''
+    Function to read the bytes of a stored element from its Entry without the sink, e.g. in another process.
+    Elements written to a shard that is still open need the sink's flush() first.
+    '''
+    if entry.shard is None:
+        with open(entry.location, 'rb') as f:
+            return f.read()
+    with open(entry.shard, 'rb') as f:
+        offset = entry.offset
+        if entry.shard.endswith('.zip'):
+            # The data follows the 30 byte local header and its name and extra fields #
+            f.seek(offset)
+            name_length, extra_length = struct.unpack('<HH', f.read(30)[26:30])
+            offset += 30 + name_length + extra_length
+        f.seek(offset)
+        return f.read(entry.size)
+
+
+def _file_name(url):
+    return os.path.basename(url).replace(':', '')
+
+
+def _safe_name(name):
+    return re.sub(r'[^\w.-]+', '_', name).strip('_')
+
+
+def _to_microseconds(timestamp):
+    if isinstance(timestamp, str):
+        timestamp = datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return (timestamp - _EPOCH) // datetime.timedelta(microseconds=1)
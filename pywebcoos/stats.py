@@ -0,0 +1,128 @@
+import threading
+import time
+
+
+class RequestInfo():
+    '''
+    Details of one HTTP request, passed to the on_request_start and on_request_end hooks.
+
+    attributes:
+    _ _ _ _ _ _
+    url : str
+        The requested url.
+    url_class : str
+        The kind of request: 'assets', 'inventory', 'elements' or 'file'.
+    attempt : int
+        0 for the first try, 1 for the first retry and so on.
+    status : int
+        HTTP status code, or None if no response was received (set at the end of the request).
+    bytes : int
+        Bytes of response body received (set at the end of the request).
+    latency : float
+        Seconds from sending the request to finishing with the response (set at the end of the request).
+    error : Exception
+        The exception raised by the request, if any (set at the end of the request).
+    '''
+
+    def __init__(self, url, url_class, attempt):
+        self.url = url
+        self.url_class = url_class
+        self.attempt = attempt
+        self.status = None
+        self.bytes = 0
+        self.latency = None
+        self.error = None
+        self.start = time.perf_counter()
+
+
+class RunStats():
+
+    def __init__(self, name):
+        '''
+        Class to hold performance statistics of one API call (e.g. one download).
+
+        attributes:
+        _ _ _ _ _ _
+        name : str
+            Name of the API method.
+        wall_time : float
+            Seconds the call took.
+        requests : int
+            Number of HTTP requests made, including retries.
+        retries : int
+            Number of those requests that were retries.
+        pages : int
+            Number of element pages fetched.
+        elements : int
+            Number of elements listed (before interval filtering).
+        files : int
+            Number of files downloaded.
+        bytes : int
+            Bytes of response body received.
+        stage_times : dict
+            Seconds between the start of the first and the end of the last request of each url class
+            ('assets', 'inventory', 'elements', 'file'). Stages can overlap.
+        request_times : dict
+            Summed latency of the requests of each url class.
+        '''
+        self.name = name
+        self.wall_time = None
+        self.requests = 0
+        self.retries = 0
+        self.pages = 0
+        self.elements = 0
+        self.files = 0
+        self.bytes = 0
+        self.stage_times = {}
+        self.request_times = {}
+        self._stage_spans = {}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (f"RunStats({self.name}: {self.wall_time:.3f} s, {self.requests} requests, {self.retries} retries, "
+                f"{self.pages} pages, {self.elements} elements, {self.files} files, {self.bytes} bytes)"
+                if self.wall_time is not None else f"RunStats({self.name}: running)")
+
+    @property
+    def throughput(self):
+        '''
+        Bytes received per second of wall time.
+        '''
+        return self.bytes / self.wall_time if self.wall_time else 0.0
+
+    @property
+    def files_per_second(self):
+        return self.files / self.wall_time if self.wall_time else 0.0
+
+    def add(self, pages=0, elements=0, files=0):
+        with self._lock:
+            self.pages += pages
+            self.elements += elements
+            self.files += files
+
+    def add_request(self, info):
+        '''
+        Function to record a finished request.
+        '''
+        end = info.start + info.latency
+        with self._lock:
+            self.requests += 1
+            self.retries += info.attempt > 0
+            self.bytes += info.bytes
+            self.request_times[info.url_class] = self.request_times.get(info.url_class, 0.0) + info.latency
+            first, last = self._stage_spans.get(info.url_class, (info.start, end))
+            self._stage_spans[info.url_class] = (min(first, info.start), max(last, end))
+            self.stage_times[info.url_class] = self._stage_spans[info.url_class][1] - self._stage_spans[info.url_class][0]
+
+    def finish(self):
+        self.wall_time = time.perf_counter() - self._start
+
+    def as_dict(self):
+        '''
+        Function to get the statistics as a dict, e.g. for exporting to a metrics system.
+        '''
+        return {'name': self.name, 'wall_time': self.wall_time, 'requests': self.requests, 'retries': self.retries,
+                'pages': self.pages, 'elements': self.elements, 'files': self.files, 'bytes': self.bytes,
+                'throughput': self.throughput, 'files_per_second': self.files_per_second,
+                'stage_times': dict(self.stage_times), 'request_times': dict(self.request_times)}
@@ -0,0 +1,279 @@
+"""
+A local stand-in for the WebCOOS API, for offline tests and benchmarks.
+"""
+
+import datetime
+import email.utils
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_CAMERAS = [{'name': 'Charleston Harbor, SC',
+                    'slug': 'nwlon_charleston',
+                    'timezone': 'America/New_York'}]
+
+# Products served for every camera, with their file extension and the spacing of their elements #
+DEFAULT_PRODUCTS = {'one-minute-stills': {'extension': 'jpg', 'period': 1},
+                    'video-archive': {'extension': 'mp4', 'period': 10}}
+
+
+class MockWebCOOS():
+
+    def __init__(self, token='test-token', cameras=None, start='2025-01-01T15:00:00+00:00', n_elements=1440,
+                 period_seconds=60, page_size=100, file_size=50000, latency=0.0, error_rate=0.0, seed=0):
+        '''
+        Class to run a local HTTP server that mimics the WebCOOS API: /assets/, /services/{slug}/inventory/,
+        paginated /elements/ (with ETag and Last-Modified validators) and the files themselves (with Range
+        support). Elements can be added while the server runs by increasing n_elements.
+
+        args:
+        _ _ _ _ _ _
+        token : str, optional
+            The only API token the server accepts. Default is 'test-token'.
+        cameras : list, optional
+            Cameras to serve, as dicts with 'name', 'slug' and (optionally) 'timezone' keys.
+            Default is DEFAULT_CAMERAS.
+        start : str, optional
+            UTC ISO time of the first element of every product. Default is '2025-01-01T15:00:00+00:00'.
+        n_elements : int, optional
+            Number of elements of the most frequent product. Default is 1440 (one day of one-minute stills).
+        period_seconds : float, optional
+            Seconds between elements of the most frequent product. Default is 60.
+        page_size : int, optional
+            Number of elements per /elements/ page. Default is 100.
+        file_size : int, optional
+            Size of each served file in bytes. Default is 50000.
+        latency : float, optional
+            Seconds added to every response. Default is 0.
+        error_rate : float, optional
+            Fraction of requests answered with a 503 (with Retry-After: 0). Default is 0.
+        seed : int, optional
+            Seed of the random errors. Default is 0.
+
+        Example usage:
+        _ _ _ _ _ _
+        with MockWebCOOS() as server:
+            api = API(server.token, api_base_url=server.api_base_url)
+        '''
+        self.token = token
+        self.cameras = cameras if cameras is not None else DEFAULT_CAMERAS
+        self.start = datetime.datetime.fromisoformat(start)
+        self.n_elements = n_elements
+        self.period_seconds = period_seconds
+        self.page_size = page_size
+        self.file_size = file_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        # Every file has the same body #
+        self._body = bytes(range(256)) * (file_size // 256 + 1)
+
+    def __enter__(self):
+        self.start_server()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop_server()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_base_url(self):
+        return f"{self.url}/api/v1"
+
+    def start_server(self):
+        '''
+        Function to start serving on a free localhost port in a background thread.
+        '''
+        mock = self
+
+        class Handler(_Handler):
+            server_mock = mock
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop_server(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def elements(self, slug, product):
+        '''
+        Function to get the number of elements of a service and the seconds between them.
+        '''
+        period = self.period_seconds * DEFAULT_PRODUCTS[product]['period']
+        return math.ceil(self.n_elements / DEFAULT_PRODUCTS[product]['period']), period
+
+    def _count(self, kind):
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+    def _fail(self):
+        if self.error_rate <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def _services(self):
+        services = {}
+        for camera in self.cameras:
+            for product in DEFAULT_PRODUCTS:
+                services[f"{camera['slug']}-{product}"] = (camera, product)
+        return services
+
+    def _element_time(self, i, period):
+        return self.start + datetime.timedelta(seconds=i * period)
+
+    def _assets(self):
+        results = []
+        for camera in self.cameras:
+            products = [{'data': {'common': {'label': product}},
+                         'services': [{'data': {'common': {'slug': f"{camera['slug']}-{product}"}}}]}
+                        for product in DEFAULT_PRODUCTS]
+            properties = {'timezone': camera['timezone']} if camera.get('timezone') else {}
+            results.append({'data': {'common': {'label': camera['name']}, 'properties': properties},
+                            'feeds': [{'data': {'common': {'label': 'raw-video-data'}}, 'products': products}]})
+        return {'results': results}
+
+    def _inventory(self, slug):
+        camera, product = self._services()[slug]
+        n, period = self.elements(slug, product)
+        end = self._element_time(n - 1, period)
+        rows = []
+        bin_start = self.start.replace(minute=0, second=0, microsecond=0)
+        while bin_start <= end:
+            bin_end = bin_start + datetime.timedelta(hours=1)
+            i_lo = max(0, math.ceil((bin_start - self.start).total_seconds() / period))
+            i_hi = min(n, math.ceil((bin_end - self.start).total_seconds() / period))
+            count = max(0, i_hi - i_lo)
+            rows.append([bin_start.isoformat(), count > 0, bin_end.isoformat(), count, count * self.file_size,
+                         self._element_time(i_lo, period).isoformat() if count else None,
+                         self._element_time(i_hi - 1, period).isoformat() if count else None])
+            bin_start = bin_end
+        return {'results': [{'values': rows}]}
+
+    def _elements(self, query):
+        slug = query['service']
+        camera, product = self._services()[slug]
+        n, period = self.elements(slug, product)
+        after = datetime.datetime.fromisoformat(query['starting_after'].replace('Z', '+00:00'))
+        i_lo = max(0, math.ceil((after - self.start).total_seconds() / period))
+        i_hi = n - 1
+        if query.get('starting_before'):
+            before = datetime.datetime.fromisoformat(query['starting_before'].replace('Z', '+00:00'))
+            i_hi = min(i_hi, math.floor((before - self.start).total_seconds() / period))
+        page = int(query.get('page', 1))
+        first = i_lo + (page - 1) * self.page_size
+        last = min(i_hi, first + self.page_size - 1)
+        results = []
+        for i in range(first, last + 1):
+            t = self._element_time(i, period)
+            fname = f"{camera['slug']}-{t:%Y-%m-%d-%H%M%S}Z.{DEFAULT_PRODUCTS[product]['extension']}"
+            results.append({'id': f"{slug}-{i}",
+                            'data': {'common': {'label': fname},
+                                     'extents': {'temporal': {'min': t.isoformat(), 'max': t.isoformat()}},
+                                     'properties': {'url': f"{self.url}/files/{slug}/{fname}",
+                                                    'size': self.file_size}}})
+        next_url = None
+        if last < i_hi:
+            next_query = dict(query, page=page + 1)
+            next_url = f"{self.api_base_url}/elements/?{urllib.parse.urlencode(next_query)}"
+        return {'results': results, 'pagination': {'next': next_url}}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, so don't let Nagle's algorithm delay the body #
+    disable_nagle_algorithm = True
+    server_mock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        mock = self.server_mock
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        parts = [p for p in url.path.split('/') if p]
+        if mock.latency:
+            time.sleep(mock.latency)
+
+        if parts[:1] == ['files']:
+            kind = 'file'
+        elif parts[2:3] == ['services']:
+            kind = 'inventory'
+        else:
+            kind = parts[2] if len(parts) > 2 else 'unknown'
+        mock._count(kind)
+
+        if mock._fail():
+            return self._send(503, b'', {'Retry-After': '0'})
+        if kind == 'file':
+            return self._send_file()
+        if self.headers.get('Authorization') != f'Token {mock.token}':
+            return self._send_json(401, {'detail': 'Invalid token.'})
+        if kind == 'assets':
+            return self._send_json(200, mock._assets())
+        if kind == 'inventory' and parts[3] in mock._services():
+            return self._send_json(200, mock._inventory(parts[3]))
+        if kind == 'elements' and query.get('service') in mock._services():
+            return self._send_elements(mock._elements(query))
+        return self._send_json(404, {'detail': 'Not found.'})
+
+    def _send_file(self):
+        mock = self.server_mock
+        body = mock._body[:mock.file_size]
+        headers = {}
+        status = 200
+        range_header = self.headers.get('Range')
+        if range_header:
+            offset = int(range_header.split('=')[1].split('-')[0])
+            if offset >= len(body):
+                return self._send(416, b'', {'Content-Range': f'bytes */{len(body)}'})
+            headers['Content-Range'] = f'bytes {offset}-{len(body) - 1}/{len(body)}'
+            body = body[offset:]
+            status = 206
+        headers['Content-Type'] = 'application/octet-stream'
+        self._send(status, body, headers)
+
+    def _send_elements(self, obj):
+        # Validators change whenever the listed elements do #
+        body = json.dumps(obj).encode('utf-8')
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        headers = {'ETag': etag}
+        if obj['results']:
+            newest = datetime.datetime.fromisoformat(obj['results'][-1]['data']['extents']['temporal']['min'])
+            headers['Last-Modified'] = email.utils.format_datetime(newest, usegmt=True)
+        if self.headers.get('If-None-Match') == etag:
+            self.server_mock._count('not_modified')
+            return self._send(304, b'', headers)
+        headers['Content-Type'] = 'application/json'
+        self._send(200, body, headers)
+
+    def _send_json(self, status, obj):
+        self._send(status, json.dumps(obj).encode('utf-8'), {'Content-Type': 'application/json'})
+
+    def _send(self, status, body, headers):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
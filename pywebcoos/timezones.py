@@ -1,6 +1,3 @@
-import numpy as np
-
-
 TIMEZONES_BY_STATE = {'ME': 'America/New_York',
                       'NH': 'America/New_York',
                       'MA': 'America/New_York',
@@ -33,13 +30,7 @@ TIMEZONES_BY_STATE = {'ME': 'America/New_York',
 
 
 def from_name(camera_name):
-    sbool = [' '+k in camera_name for k in list(TIMEZONES_BY_STATE.keys())]
-    if np.sum(sbool) > 0:
-        state_abbrev = np.array(list(TIMEZONES_BY_STATE.keys()))[sbool][0]
-        return TIMEZONES_BY_STATE[state_abbrev]
-    else:
-        raise ValueError('Camera name does not contain state abbreviation')
-    
-
-
-    
+    for state_abbrev, timezone in TIMEZONES_BY_STATE.items():
+        if ' '+state_abbrev in camera_name:
+            return timezone
+    raise ValueError('Camera name does not contain state abbreviation')
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import pytest
 import pywebcoos
@@ -129,6 +130,123 @@ def test_download_images():
     os.remove('nwlon_charleston-2025-01-01-150023Z.jpg')
 
 
+def test_download_images_concurrently():
+    key = _get_key()
+    api = pywebcoos.API(str(key))
+    fname = api.download('Charleston Harbor, SC',
+                         'one-minute-stills',
+                         '202501011000',
+                         '202501011004',
+                         1,
+                         '.',
+                         max_workers=4)
+    assert len(fname) == 5 , 'Concurrent image download failed.'
+    assert fname == sorted(fname) , 'Concurrent image download did not preserve element order.'
+    for f in fname:
+        os.remove(f)
+
+
+def test_async_download_images():
+    key = _get_key()
+
+    async def run():
+        async with pywebcoos.AsyncAPI(str(key)) as api:
+            prods = await api.get_products('Charleston Harbor, SC')
+            assert 'one-minute-stills' in prods , 'Getting product list asynchronously failed'
+            return await api.download('Charleston Harbor, SC',
+                                      'one-minute-stills',
+                                      '202501011000',
+                                      '202501011001',
+                                      1,
+                                      '.')
+
+    fname = asyncio.run(run())
+    assert len(fname) > 0 , 'Asynchronous image download failed.'
+    os.remove('nwlon_charleston-2025-01-01-150023Z.jpg')
+
+
+def test_cached_metadata_is_reused(tmp_path):
+    key = _get_key()
+    api = pywebcoos.API(str(key), cache_dir=str(tmp_path))
+    inv = api.get_inventory('Charleston Harbor, SC', 'video-archive')
+    api2 = pywebcoos.API(str(key), cache_dir=str(tmp_path))
+    assert api2.assets_json == api.assets_json , 'Cached assets do not match downloaded assets'
+    assert api2.get_inventory('Charleston Harbor, SC', 'video-archive') == inv , 'Cached inventory does not match downloaded inventory'
+    api2.refresh()
+    assert len(api2.get_cameras()) > 0 , 'Refreshing cached metadata failed'
+
+
+def test_download_with_parallel_queries_matches_serial():
+    key = _get_key()
+    api = pywebcoos.API(str(key))
+    serial = api.download('Charleston Harbor, SC', 'one-minute-stills', '202501011000', '202501011200', 30, '.')
+    parallel = api.download('Charleston Harbor, SC', 'one-minute-stills', '202501011000', '202501011200', 30, '.',
+                            query_workers=4)
+    assert parallel == serial , 'Parallel element queries returned different files than a single query.'
+    for f in serial:
+        os.remove(f)
+
+
+def test_download_many_reports_per_job_results():
+    key = _get_key()
+    api = pywebcoos.API(str(key))
+    results = api.download_many([('Charleston Harbor, SC', 'one-minute-stills', '202501011000', '202501011001', 1, '.'),
+                                 ('Not a camera', 'video-archive', '202401011000', '202401011010', 1, '.')])
+    assert len(results[0]['filenames']) > 0 and results[0]['error'] is None , 'Bulk image download failed.'
+    assert isinstance(results[1]['error'], ValueError) , 'Failing bulk download job was not reported.'
+    for f in results[0]['filenames']:
+        os.remove(f)
+
+
+def test_retry_policy_backoff_and_retry_after():
+    policy = pywebcoos.RetryPolicy(backoff=1, max_backoff=10, jitter=False)
+    assert [policy.delay(i) for i in range(5)] == [1, 2, 4, 8, 10] , 'Retry backoff is not exponential and capped'
+    assert policy.delay(0, '7') == 7 , 'Retry-After header was not honoured'
+    assert policy.should_retry(429) and not policy.should_retry(404) , 'Retryable statuses are wrong'
+
+
+def test_iter_download_images_in_memory():
+    key = _get_key()
+    api = pywebcoos.API(str(key))
+    frames = []
+    for timestamp, element, data in api.iter_download('Charleston Harbor, SC',
+                                                      'one-minute-stills',
+                                                      '202501011000',
+                                                      '202501011002',
+                                                      1,
+                                                      reuse_buffers=True):
+        frames.append((timestamp, bytes(data)))
+    assert len(frames) > 0 , 'In-memory image download failed.'
+    assert all(len(data) > 0 for timestamp, data in frames) , 'In-memory image download returned empty files.'
+    assert [t for t, d in frames] == sorted(t for t, d in frames) , 'In-memory image download is out of order.'
+
+
+def test_sync_only_downloads_new_files(tmp_path):
+    key = _get_key()
+    api = pywebcoos.API(str(key))
+    first = api.sync('Charleston Harbor, SC', 'one-minute-stills', str(tmp_path), interval=30, start='202510301000')
+    assert len(first) > 0 , 'Initial sync downloaded no files.'
+    second = api.sync('Charleston Harbor, SC', 'one-minute-stills', str(tmp_path), interval=30)
+    assert not set(first) & set(second) , 'Sync downloaded files that were already synced.'
+
+
+def test_list_elements():
+    key = _get_key()
+    api = pywebcoos.API(str(key))
+    elements = api.list_elements('Charleston Harbor, SC', 'one-minute-stills', '202501011000', '202501011100', 10)
+    assert len(elements) > 0 , 'Element listing failed.'
+    assert all(t.minute % 10 == 0 for t in elements.to_pandas()['Timestamp']) , 'Elements were not filtered to the interval.'
+
+
+def test_download_daily_schedule(tmp_path):
+    from pywebcoos.schedule import Daily
+    key = _get_key()
+    api = pywebcoos.API(str(key))
+    fnames = api.download('Charleston Harbor, SC', 'one-minute-stills', Daily('1000', '1001', 20250101, 20250102), None, 1,
+                          str(tmp_path), query_workers=2)
+    assert len(set(os.path.basename(f)[:-15] for f in fnames)) == 2 , 'Scheduled download did not cover each day.'
+
+
 # Integration test #
 def test_function_integration():
     key = _get_key()
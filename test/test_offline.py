@@ -0,0 +1,495 @@
+import datetime
+import os
+import sys
+import threading
+import numpy as np
+import pytest
+import pywebcoos
+from pywebcoos.testing import MockWebCOOS
+
+
+# Tests against a local mock WebCOOS server, so no API key or network access is needed #
+CAMERA = 'Charleston Harbor, SC'
+
+
+@pytest.fixture(scope='module')
+def server():
+    with MockWebCOOS(n_elements=300, page_size=25, file_size=5000) as server:
+        yield server
+
+
+@pytest.fixture
+def api(server):
+    return pywebcoos.API(server.token, api_base_url=server.api_base_url,
+                         retry=pywebcoos.RetryPolicy(backoff=0.01))
+
+
+def test_invalid_api_token_raises_exception(server):
+    with pytest.raises(ValueError, match="API access token is not valid."):
+        pywebcoos.API('Invalid token', api_base_url=server.api_base_url)
+
+
+def test_get_inventory(api):
+    assert api.get_inventory(CAMERA, 'one-minute-stills') == ['2025-01-01T15:00:00+00:00', '2025-01-01T20:00:00+00:00']
+
+
+def test_download_skips_existing_files(api, server, tmp_path):
+    fnames = api.download(CAMERA, 'one-minute-stills', '202501011000', '202501011030', 5, str(tmp_path))
+    assert len(fnames) == 7
+    assert all(os.path.getsize(f) == server.file_size for f in fnames)
+    n_files = server.requests['file']
+    assert api.download(CAMERA, 'one-minute-stills', '202501011000', '202501011030', 5, str(tmp_path)) == fnames
+    assert server.requests['file'] == n_files , 'Existing files were requested again'
+
+
+def test_concurrent_download_matches_serial(api, tmp_path):
+    adapter = api.session.get_adapter(api.api_base_url)
+    serial = api.download(CAMERA, 'one-minute-stills', '202501011000', '202501011200', 1, str(tmp_path / 'serial'))
+    concurrent = api.download(CAMERA, 'one-minute-stills', '202501011000', '202501011200', 1, str(tmp_path / 'concurrent'),
+                              max_workers=8, query_workers=3)
+    assert [os.path.basename(f) for f in concurrent] == [os.path.basename(f) for f in serial]
+    # The warm connection pool is kept #
+    assert api.session.get_adapter(api.api_base_url) is adapter
+
+
+def test_download_resumes_part_file(api, server, tmp_path):
+    fname = api._get_filename(f"{server.url}/files/nwlon_charleston-2025-01-01-150000Z.jpg", str(tmp_path))
+    with open(fname + '.part', 'wb') as f:
+        f.write(server._body[:1000])
+    fnames = api.download(CAMERA, 'one-minute-stills', '202501011000', '202501011000', 1, str(tmp_path))
+    assert fnames == [fname]
+    with open(fname, 'rb') as f:
+        assert f.read() == server._body[:server.file_size]
+    assert not os.path.exists(fname + '.part')
+    # A .part file longer than the file (e.g. left by an older version of it) is downloaded again #
+    os.remove(fname)
+    with open(fname + '.part', 'wb') as f:
+        f.write(bytes(server.file_size + 500))
+    assert api.download(CAMERA, 'one-minute-stills', '202501011000', '202501011000', 1, str(tmp_path)) == [fname]
+    with open(fname, 'rb') as f:
+        assert f.read() == server._body[:server.file_size]
+    # A complete .part file of an element without a size is taken as it is #
+    os.replace(fname, fname + '.part')
+    element = api.list_elements(CAMERA, 'one-minute-stills', '202501011000', '202501011000', 1)[0]
+    api._download_file(element.url, fname)
+    with open(fname, 'rb') as f:
+        assert f.read() == server._body[:server.file_size]
+
+
+def test_download_retries_server_errors(server, tmp_path):
+    with MockWebCOOS(n_elements=60, page_size=10, file_size=1000, error_rate=0.3) as flaky:
+        api = pywebcoos.API(flaky.token, api_base_url=flaky.api_base_url,
+                            retry=pywebcoos.RetryPolicy(retries=20, backoff=0.001))
+        fnames = api.download(CAMERA, 'one-minute-stills', '202501011000', '202501011059', 1, str(tmp_path), max_workers=4)
+    assert len(fnames) == 60
+
+
+def test_iter_download(api, server):
+    frames = list(api.iter_download(CAMERA, 'one-minute-stills', '202501011000', '202501011009', 1,
+                                    max_buffer_bytes=2 * server.file_size))
+    assert len(frames) == 10
+    assert [t for t, e, d in frames] == sorted(t for t, e, d in frames)
+    assert all(bytes(d) == server._body[:server.file_size] for t, e, d in frames)
+
+
+def test_iter_download_budget_and_exported_buffers(api, server, monkeypatch):
+    module = sys.modules['pywebcoos.API']
+    peak = [0]
+    charge = module._ByteBudget.charge
+
+    def record(budget, position, n_bytes):
+        charge(budget, position, n_bytes)
+        peak[0] = max(peak[0], budget.used)
+
+    monkeypatch.setattr(module._ByteBudget, 'charge', record)
+    # Files of unknown size are charged as their bytes arrive #
+    elements = [e._replace(size=None) for e in api.list_elements(CAMERA, 'one-minute-stills', '202501011000', '202501011009', 1)]
+    frames = []
+    for timestamp, element, data in api._iter_fetched(elements, 4, server.file_size, True, 1000):
+        # Holding on to the data keeps its buffer exported, so it must not be reused #
+        frames.append(np.frombuffer(data, dtype=np.uint8))
+    assert len(frames) == 10
+    assert all(frame.tobytes() == server._body[:server.file_size] for frame in frames)
+    assert 0 < peak[0] <= 2 * server.file_size
+
+
+def test_download_many(api, tmp_path):
+    results = api.download_many([(CAMERA, 'one-minute-stills', '202501011000', '202501011009', 1, str(tmp_path / 'a')),
+                                 ('Not a camera', 'one-minute-stills', '202501011000', '202501011009', 1, str(tmp_path / 'b')),
+                                 (CAMERA, 'video-archive', '202501011000', '202501011100', 1, str(tmp_path / 'c'))])
+    assert [len(r['filenames']) for r in results] == [10, 0, 7]
+    assert isinstance(results[1]['error'], ValueError)
+    # A job that fails part way reports the files it had in place #
+    os.makedirs(str(tmp_path / 'd' / 'nwlon_charleston-2025-01-01-150500Z.jpg.part'))
+    results = api.download_many([(CAMERA, 'one-minute-stills', '202501011000', '202501011009', 1, str(tmp_path / 'd'))])
+    assert isinstance(results[0]['error'], OSError)
+    assert len(results[0]['filenames']) == 9 and all(os.path.exists(f) for f in results[0]['filenames'])
+    # Jobs writing to shards fetch with the shared pool of max_workers threads too #
+    from pywebcoos import sinks
+
+    class ThreadHook():
+        def __init__(self):
+            self.threads = set()
+
+        def on_request_end(self, info):
+            if info.url_class == 'file':
+                self.threads.add(threading.current_thread().name)
+
+    hook = ThreadHook()
+    api.add_hook(hook)
+    with sinks.TarSink(str(tmp_path / 'e')) as e, sinks.TarSink(str(tmp_path / 'f')) as f:
+        results = api.download_many([(CAMERA, 'one-minute-stills', '202501011000', '202501011029', 1, e),
+                                     (CAMERA, 'one-minute-stills', '202501011030', '202501011059', 1, f)], max_workers=2)
+    assert [len(r['filenames']) for r in results] == [30, 30]
+    assert len(hook.threads) <= 2
+
+
+def test_sync_only_downloads_new_files(server, tmp_path):
+    with MockWebCOOS(n_elements=30) as growing:
+        api = pywebcoos.API(growing.token, api_base_url=growing.api_base_url)
+        assert len(api.sync(CAMERA, 'one-minute-stills', str(tmp_path))) == 30
+        growing.n_elements = 45
+        assert len(api.sync(CAMERA, 'one-minute-stills', str(tmp_path))) == 15
+        assert api.sync(CAMERA, 'one-minute-stills', str(tmp_path)) == []
+    # A product with no data yet has nothing to sync #
+    with MockWebCOOS(n_elements=0) as empty:
+        api = pywebcoos.API(empty.token, api_base_url=empty.api_base_url)
+        assert api.sync(CAMERA, 'one-minute-stills', str(tmp_path / 'empty')) == []
+        assert 'elements' not in empty.requests
+
+
+def test_cache_serves_metadata_locally(server, tmp_path):
+    n_assets = server.requests.get('assets', 0)
+    apis = [pywebcoos.API(server.token, api_base_url=server.api_base_url, cache_dir=str(tmp_path)) for _ in range(3)]
+    assert server.requests['assets'] == n_assets + 1
+    n_inventory = server.requests.get('inventory', 0)
+    for api in apis:
+        api.get_inventory(CAMERA, 'video-archive')
+    assert server.requests['inventory'] == n_inventory + 1
+
+
+def test_async_download(server, tmp_path):
+    pytest.importorskip('aiohttp')
+    import asyncio
+
+    async def run():
+        async with pywebcoos.AsyncAPI(server.token, api_base_url=server.api_base_url) as api:
+            return await api.download(CAMERA, 'one-minute-stills', '202501011000', '202501011009', 1, str(tmp_path))
+
+    # A .part file left by an interrupted download is resumed #
+    part_filename = os.path.join(str(tmp_path), 'nwlon_charleston-2025-01-01-150000Z.jpg.part')
+    with open(part_filename, 'wb') as f:
+        f.write(server._body[:1000])
+    # and a .part file longer than the file is downloaded again #
+    with open(part_filename.replace('150000Z', '150100Z'), 'wb') as f:
+        f.write(bytes(server.file_size + 500))
+    fnames = asyncio.run(run())
+    assert len(fnames) == 10
+    assert all(os.path.getsize(f) == server.file_size for f in fnames)
+    with open(fnames[0], 'rb') as f:
+        assert f.read() == server._body[:server.file_size]
+    assert not os.path.exists(part_filename)
+    # Only the core methods are async, the rest are not inherited in a broken state #
+    assert not hasattr(pywebcoos.AsyncAPI, 'list_elements')
+    assert not hasattr(pywebcoos.AsyncAPI, 'iter_download')
+
+
+def test_hooks_and_stats(server, tmp_path):
+    class Hook():
+        def __init__(self):
+            self.requests = []
+            self.stats = []
+
+        def on_request_end(self, info):
+            self.requests.append(info)
+
+        def on_stats(self, stats):
+            self.stats.append(stats)
+
+    hook = Hook()
+    api = pywebcoos.API(server.token, api_base_url=server.api_base_url, hooks=[hook])
+    fnames = api.download(CAMERA, 'one-minute-stills', '202501011000', '202501011059', 1, str(tmp_path), max_workers=4)
+    stats = api.last_stats
+    assert stats.name == 'download' and stats is hook.stats[-1]
+    assert stats.files == len(fnames) == 60
+    assert stats.pages == 3 and stats.elements == 60
+    assert stats.bytes >= 60 * server.file_size
+    assert sum(1 for info in hook.requests if info.url_class == 'file') == 60
+    assert all(info.status == 200 for info in hook.requests)
+
+
+def test_stats_of_concurrent_calls(server, tmp_path):
+    class Hook():
+        def __init__(self):
+            self.stats = []
+
+        def on_stats(self, stats):
+            self.stats.append(stats)
+
+    api = pywebcoos.API(server.token, api_base_url=server.api_base_url)
+    hook = Hook()
+    api.add_hook(hook)
+    # Two downloads running at once from different threads each get their own stats #
+    threads = [threading.Thread(target=api.download, args=(CAMERA, 'one-minute-stills', '202501011000', '202501011059',
+                                                           1, str(tmp_path / name)), kwargs={'max_workers': 4})
+               for name in ('a', 'b')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [stats.name for stats in hook.stats] == ['download', 'download']
+    assert [stats.files for stats in hook.stats] == [60, 60]
+    assert [stats.elements for stats in hook.stats] == [60, 60]
+    # iter_download keeps counting after it returns its generator #
+    assert sum(1 for item in api.iter_download(CAMERA, 'one-minute-stills', '202501011000', '202501011009', 1)) == 10
+    assert hook.stats[-1].name == 'iter_download' and hook.stats[-1].files == 10
+
+
+def test_lazy_construction(server):
+    n_assets = server.requests.get('assets', 0)
+    api = pywebcoos.API(server.token, api_base_url=server.api_base_url, lazy=True)
+    assert server.requests.get('assets', 0) == n_assets
+    assert 'video-archive' in api.get_products(CAMERA)
+    assert server.requests['assets'] == n_assets + 1
+    assert list(api.get_cameras()['Camera Name']) == [CAMERA]
+    # The camera list is available as an attribute, loading the assets on first access #
+    assert list(pywebcoos.API(server.token, api_base_url=server.api_base_url).cameras['Camera Name']) == [CAMERA]
+    lazy = pywebcoos.API(server.token, api_base_url=server.api_base_url, lazy=True)
+    assert list(lazy.cameras['Camera Name']) == [CAMERA]
+    with pytest.raises(ValueError, match="API access token is not valid."):
+        pywebcoos.API('Invalid token', api_base_url=server.api_base_url, lazy=True).get_cameras()
+
+
+def test_watch_follows_new_elements(tmp_path):
+    with MockWebCOOS(n_elements=20, page_size=10, file_size=1000) as growing:
+        api = pywebcoos.API(growing.token, api_base_url=growing.api_base_url)
+        seen = []
+
+        def callback(timestamp, element, fname):
+            seen.append(fname)
+            if len(seen) == 20:
+                growing.n_elements = 25  # New elements arrive between polls #
+
+        assert api.watch(CAMERA, 'one-minute-stills', callback, save_dir=str(tmp_path), start='202501011000',
+                         poll_interval=0, max_polls=3) == 25
+        assert len(set(seen)) == 25 and all(os.path.getsize(f) == 1000 for f in seen)
+        assert 'inventory' not in growing.requests
+        # Polling with nothing new is answered with a 304 #
+        assert api.watch(CAMERA, 'one-minute-stills', callback, poll_interval=0, max_polls=3) == 0
+        assert growing.requests['not_modified'] == 2
+
+        # A callback that raises only loses its element #
+        def failing_callback(timestamp, element, data):
+            if element.timestamp.minute == 5:
+                raise RuntimeError('callback failed')
+
+        assert api.watch(CAMERA, 'one-minute-stills', failing_callback, start='202501011000', poll_interval=0,
+                         max_polls=1) == 24
+
+
+def test_list_elements(api):
+    elements = api.list_elements(CAMERA, 'one-minute-stills', '202501011000', '202501011100', 15, query_workers=2)
+    assert [e.timestamp.minute for e in elements] == [0, 15, 30, 45, 0]
+    assert list(elements.sizes) == [5000] * 5
+    df = elements.to_pandas()
+    assert list(df.columns) == ['Timestamp', 'URL', 'Size', 'ID']
+    assert df['URL'].iloc[0] == elements[0].url
+    # The query windows are half-open, so they neither overlap nor leave gaps #
+    service_slug, inventory = api._get_service_slug(CAMERA, 'one-minute-stills')
+    windows = api._plan_queries(inventory, '2025-01-01T15:00:00+00:00', '2025-01-01T20:00:00+00:00', 4)
+    assert len(windows) > 1
+    for (w0, w1), (next_w0, next_w1) in zip(windows, windows[1:]):
+        assert api._parse_iso(next_w0) - api._parse_iso(w1) == datetime.timedelta(microseconds=1)
+
+
+def test_sampling(tmp_path):
+    from pywebcoos.sampling import Every, Nearest
+    # Elements every 7 seconds, listed 10 to a page so samples straddle page boundaries #
+    with MockWebCOOS(n_elements=1000, period_seconds=7, page_size=10, file_size=100) as fast:
+        api = pywebcoos.API(fast.token, api_base_url=fast.api_base_url)
+
+        def times(interval):
+            elements = api.list_elements(CAMERA, 'one-minute-stills', '202501011000', '202501011100', interval)
+            return [e.timestamp.strftime('%H:%M:%S') for e in elements]
+
+        assert times(Every('15min')) == ['15:00:00', '15:15:03', '15:30:06', '15:45:02']
+        assert times(Every('30min', offset='10min', max_per_bin=2))[:4] == ['15:00:00', '15:00:07', '15:10:02', '15:10:09']
+        assert times(Nearest('20min')) == ['15:00:00', '15:19:57', '15:40:01', '15:59:58']
+        assert times(Nearest('20min', offset='10s', tolerance='1s')) == ['15:20:11']
+        assert times('30min') == times(Every(1800))
+        # Legacy interval: every element in minutes 0, 10, ... 50 #
+        assert len(times(10)) == sum(1 for i in range(515) if (i * 7 // 60) % 10 == 0)
+        fnames = api.download(CAMERA, 'one-minute-stills', '202501011000', '202501011100', Nearest('20min'), str(tmp_path))
+        assert len(fnames) == 4
+        with pytest.raises(ValueError):
+            api.download(CAMERA, 'one-minute-stills', '202501011000', '202501011100', 0, str(tmp_path))
+
+
+def test_download_windows_and_schedule(tmp_path):
+    from pywebcoos.schedule import Daily
+    with MockWebCOOS(n_elements=3 * 1440, page_size=100, file_size=100) as days:
+        api = pywebcoos.API(days.token, api_base_url=days.api_base_url)
+        fnames = api.download(CAMERA, 'one-minute-stills', Daily('1000', '1010', 20250101, 20250103), None, 1,
+                              str(tmp_path / 'daily'), query_workers=3)
+        assert len(fnames) == 33
+        assert days.requests['elements'] == 3
+        # Windows with a short gap between them are listed in one query #
+        n_elements = days.requests['elements']
+        fnames = api.download(CAMERA, 'one-minute-stills', [('202501021010', '202501021015'), ('202501021000', '202501021005')],
+                              None, 5, str(tmp_path / 'windows'))
+        assert [os.path.basename(f)[-11:-5] for f in fnames] == ['150000', '150500', '151000', '151500']
+        assert days.requests['elements'] == n_elements + 1
+        with pytest.raises(ValueError):
+            api.download(CAMERA, 'one-minute-stills', [('202501021010', '202501021005')], None, 1, str(tmp_path))
+
+
+def test_schedule_query_count():
+    with MockWebCOOS(n_elements=3 * 1440, page_size=100, file_size=100) as days:
+        api = pywebcoos.API(days.token, api_base_url=days.api_base_url)
+        # 10 minutes at the start of every hour for 3 days: 72 windows of 11 elements, 49 elements apart #
+        hours = [datetime.datetime(2025, 1, 1, 10) + datetime.timedelta(hours=h) for h in range(72)]
+        windows = [(f"{t:%Y%m%d%H%M}", f"{t + datetime.timedelta(minutes=10):%Y%m%d%H%M}") for t in hours]
+        elements = api.list_elements(CAMERA, 'one-minute-stills', windows, None, 1)
+        assert len(elements) == 72 * 11
+        # Pairs of windows fit in one page, so 36 one-page queries beat 72 queries or one 44 page query #
+        assert days.requests['elements'] == 36
+
+
+def test_local_to_utc_matches_local2iso(api):
+    import numpy as np
+    # Hours around the 2025 US DST changes, including the skipped and repeated hours #
+    local = np.concatenate([np.arange(np.datetime64('2025-03-09T00:00'), np.datetime64('2025-03-09T05:00'), 30),
+                            np.arange(np.datetime64('2025-11-02T00:00'), np.datetime64('2025-11-02T03:00'), 30)])
+    utc = api._local2UTC(local, CAMERA)
+    for t, u in zip(local, utc):
+        expected = api._local2ISO(str(t).replace('-', '').replace('T', '').replace(':', ''), CAMERA)
+        assert api._parse_iso(expected).replace(tzinfo=None) == u.item()
+
+
+def test_download_shards(api, tmp_path):
+    from pywebcoos.sampling import Every
+    from pywebcoos.sharding import DownloadPlan
+    for interval in [1, Every('10min', max_per_bin=2)]:
+        whole = api.download(CAMERA, 'one-minute-stills', '202501011000', '202501011459', interval, str(tmp_path / 'whole'))
+        plan = api.plan_download(CAMERA, 'one-minute-stills', '202501011000', '202501011459', interval, n_shards=3)
+        assert plan.to_dict() == api.plan_download(CAMERA, 'one-minute-stills', '202501011000', '202501011459', interval,
+                                                   n_shards=3).to_dict()
+        assert abs(plan.total_files - len(whole)) <= 2
+        plan.save(str(tmp_path / 'plan.json'))
+        # Each shard downloads a distinct part of the job, and together they download all of it #
+        shards = [api.download_shard(str(tmp_path / 'plan.json'), i, str(tmp_path / f"shard{i}")) for i in range(3)]
+        assert all(shards)
+        assert sorted(os.path.basename(f) for shard in shards for f in shard) == sorted(os.path.basename(f) for f in whole)
+    assert DownloadPlan.load(str(tmp_path / 'plan.json')).to_dict() == plan.to_dict()
+    with pytest.raises(ValueError):
+        plan.shard(3)
+
+
+def test_shards_balanced_by_files_without_sizes():
+    from pywebcoos import sharding
+    from pywebcoos.sampling import as_sampler
+    start = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+    # An inventory without sizes is balanced by file counts #
+    inventory = [{'Bin Start': (start + datetime.timedelta(hours=h)).isoformat(),
+                  'Bin End': (start + datetime.timedelta(hours=h + 1)).isoformat(), 'Count': 60, 'Bytes': None}
+                 for h in range(6)]
+    units = sharding.plan_units(inventory, start, start + datetime.timedelta(hours=6), 3, as_sampler(1))
+    assert len(units) == 3 and all(unit[3] == 0 for unit in units)
+    assigned = sharding.assign_shards(units, 3)
+    assert sorted(unit.shard for unit in assigned) == [0, 1, 2]
+
+
+def test_download_to_sinks(api, server, tmp_path):
+    from pywebcoos import sinks
+    plain = api.download(CAMERA, 'one-minute-stills', '202501011000', '202501011100', 1, str(tmp_path / 'plain'))
+    for sink in [sinks.PartitionedSink(str(tmp_path / 'partitioned')), sinks.TarSink(str(tmp_path / 'tar'), 20000),
+                 sinks.ZipSink(str(tmp_path / 'zip'), 20000)]:
+        with sink:
+            # Appending only stores the new elements #
+            first = api.download(CAMERA, 'one-minute-stills', '202501011000', '202501011030', 1, sink, max_workers=4)
+            n_files = server.requests['file']
+            locations = api.download(CAMERA, 'one-minute-stills', '202501011000', '202501011100', 1, sink, max_workers=4)
+            assert locations[:len(first)] == first
+            assert server.requests['file'] == n_files + len(plain) - len(first)
+            assert len(sink) == len(plain)
+            entries = sink.find(CAMERA, 'one-minute-stills', '2025-01-01T15:10:00Z', '2025-01-01T15:20:00Z')
+            assert [e.timestamp.minute for e in entries] == list(range(10, 21))
+            entry = sink.nearest(CAMERA, 'one-minute-stills', '2025-01-01T15:42:20Z')
+            assert entry.timestamp.minute == 42
+            with open(plain[42], 'rb') as f:
+                assert sink.read(entry) == f.read()
+        if sink.sharded:
+            # Shards are closed once the next element would take them past max_shard_bytes (plus end of archive padding) #
+            assert len(sink.shards()) > 1
+            assert all(os.path.getsize(shard) <= 20000 + 10240 for shard in sink.shards())
+    partitioned = os.path.join(str(tmp_path / 'partitioned'), 'Charleston_Harbor_SC', 'one-minute-stills', '2025', '01', '01')
+    assert sorted(os.listdir(partitioned)) == sorted(os.path.basename(f) for f in plain)
+    # The shards are ordinary archives #
+    import tarfile
+    import zipfile
+    with tarfile.open(os.path.join(str(tmp_path / 'tar'), 'shard-000000.tar')) as tar:
+        assert len(tar.getnames()) == 3
+    with zipfile.ZipFile(os.path.join(str(tmp_path / 'zip'), 'shard-000001.zip')) as archive:
+        assert archive.testzip() is None
+
+
+def test_shard_sink_recovers_after_crash(api, server, tmp_path, monkeypatch):
+    from pywebcoos import sinks
+    import sqlite3
+    monkeypatch.setattr(sinks, 'COMMIT_EVERY', 4)
+    elements = list(api.list_elements(CAMERA, 'one-minute-stills', '202501011000', '202501011009', 1))
+    data = server._body[:server.file_size]
+    root = str(tmp_path / 'tar')
+    sink = sinks.TarSink(root)
+    for element in elements[:6]:
+        sink.write(CAMERA, 'one-minute-stills', element, data)
+    # Rows committed to the index point at data that is already in the shard #
+    with sqlite3.connect(os.path.join(root, sinks.INDEX_NAME)) as db:
+        rows = db.execute('SELECT url, location, size, shard, offset FROM elements').fetchall()
+    assert len(rows) == 4
+    for url, location, size, shard, offset in rows:
+        assert sinks.read_entry(sinks.Entry(None, url, location, size, os.path.join(root, shard), offset)) == data
+    # A crash that cuts the shard off part way through the 6th element #
+    sink.flush()
+    shard = sink.shards()[-1]
+    entry = sink.find(CAMERA, 'one-minute-stills')[5]
+    sink._archive = None
+    sink._db.close()
+    os.truncate(shard, entry.offset + 100)
+    with sinks.TarSink(root) as sink:
+        assert len(sink) == 5 and sink.location(elements[5]) is None
+        for element in elements[5:]:
+            sink.write(CAMERA, 'one-minute-stills', element, data)
+        assert all(sink.read(entry) == data for entry in sink.find(CAMERA, 'one-minute-stills'))
+    import tarfile
+    with tarfile.open(shard) as tar:
+        assert len(tar.getnames()) == 10
+
+
+def _decode_test_image(data):
+    # The mock server's files are not images, so take their first bytes as an 8x8 frame #
+    if not isinstance(data, bytes):
+        with open(data, 'rb') as f:
+            data = f.read()
+    return np.frombuffer(data[:64], dtype=np.uint8).reshape(8, 8)
+
+
+def test_stack_frames(api, server, tmp_path):
+    from pywebcoos import frames, sinks
+    fnames = api.download(CAMERA, 'one-minute-stills', '202501011000', '202501011010', 1, str(tmp_path / 'stills'))
+    times = api.list_elements(CAMERA, 'one-minute-stills', '202501011000', '202501011010', 1).times
+    stack, stack_times = frames.stack(fnames, str(tmp_path / 'stack.npy'), times, max_workers=2, decoder=_decode_test_image)
+    assert stack.shape == (11, 8, 8)
+    assert (stack == _decode_test_image(server._body)).all()
+    assert (stack_times == times).all()
+    # Entries of a sink carry their times, and elements packed in shards are decoded from their bytes #
+    with sinks.TarSink(str(tmp_path / 'tar')) as sink:
+        api.download(CAMERA, 'one-minute-stills', '202501011000', '202501011010', 1, sink)
+        entries = sink.find(CAMERA, 'one-minute-stills')
+    stack, stack_times = frames.stack(entries, str(tmp_path / 'tar.npy'), max_workers=1, decoder=_decode_test_image)
+    assert (stack == _decode_test_image(server._body)).all()
+    assert (frames.load(str(tmp_path / 'tar.npy'))[1] == times).all()
+    with pytest.raises(ValueError):
+        frames.stack(fnames, str(tmp_path / 'stack.npy'))
+    # Video frames are kept at the first frame at or after each sample time #
+    assert frames.sample_offsets(10, 5, 2)[0].tolist() == [0, 3, 5, 8]